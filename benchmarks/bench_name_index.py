@@ -0,0 +1,94 @@
+# benchmarks/bench_name_index.py
+"""
+Micro-benchmark: the original replace_usernames_with_mentions sweep versus GuildNameIndex.
+
+Run from the repository root:  python benchmarks/bench_name_index.py [member_count]
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for name in ('DISCORD_TOKEN', 'OPENROUTER_API_KEY', 'OPENROUTER_API_KEY_EXPENSIVE'):
+    os.environ.setdefault(name, 'benchmark')
+
+from helpers import GuildNameIndex
+
+SYLLABLES = ["ka", "ri", "mo", "zen", "lu", "tha", "vi", "or", "el", "syd", "ney", "qu", "ix", "ba", "no"]
+
+class FakeMember:
+    def __init__(self, member_id, name, display_name):
+        self.id = member_id
+        self.name = name
+        self.display_name = display_name
+        self.mention = f"<@{member_id}>"
+
+class FakeGuild:
+    def __init__(self, guild_id, members):
+        self.id = guild_id
+        self.members = members
+
+def legacy_replace_usernames_with_mentions(content, guild):
+    """The implementation before GuildNameIndex: one compiled regex per member name."""
+    name_to_mention = {}
+    for member in guild.members:
+        if member.display_name not in name_to_mention:
+            name_to_mention[member.display_name] = member.mention
+        if member.name not in name_to_mention:
+            name_to_mention[member.name] = member.mention
+    for name in sorted(name_to_mention.keys(), key=len, reverse=True):
+        if not name.strip():
+            continue
+        pattern = re.compile(rf'\b@?{re.escape(name)}\b', re.IGNORECASE)
+        content = pattern.sub(name_to_mention[name], content)
+    return content
+
+def make_guild(member_count, rng):
+    def make_name():
+        return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    members = []
+    for member_id in range(10**17, 10**17 + member_count):
+        name = make_name()
+        display_name = name if rng.random() < 0.5 else make_name().title()
+        members.append(FakeMember(member_id, name, display_name))
+    return FakeGuild(1, members)
+
+def make_reply(guild, rng, words=250):
+    tokens = []
+    for _ in range(words):
+        if rng.random() < 0.02:
+            tokens.append(rng.choice(guild.members).display_name)
+        else:
+            tokens.append(rng.choice(["the", "and", "you", "really", "think", "that", "is", "cute", "lol", "anon"]))
+    return ' '.join(tokens)
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - started) / repeat, result
+
+def main():
+    member_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    rng = random.Random(1234)
+    guild = make_guild(member_count, rng)
+    replies = [make_reply(guild, rng) for _ in range(20)]
+
+    started = time.perf_counter()
+    index = GuildNameIndex(guild.members)
+    build_seconds = time.perf_counter() - started
+
+    legacy_seconds, legacy_output = timed(lambda: [legacy_replace_usernames_with_mentions(reply, guild) for reply in replies[:2]], 1)
+    index_seconds, index_output = timed(lambda: [index.replace(reply) for reply in replies[:2]], 1)
+    assert legacy_output == index_output, "GuildNameIndex output differs from the legacy sweep"
+    index_seconds, _ = timed(lambda: [index.replace(reply) for reply in replies], 5)
+
+    print(f"members: {member_count}, reply length: ~{sum(map(len, replies)) // len(replies)} chars")
+    print(f"index build (once per guild)  {build_seconds * 1e3:10.1f} ms")
+    print(f"legacy sweep per reply        {legacy_seconds * 1e3 / 2:10.1f} ms")
+    print(f"GuildNameIndex per reply      {index_seconds * 1e3 / len(replies):10.2f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# benchmarks/bench_trigger_matcher.py
+"""
+Micro-benchmark: the original per-persona contains_trigger_word loop versus TriggerMatcher.
+
+Run from the repository root:  python benchmarks/bench_trigger_matcher.py
+"""
+import os
+import random
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for name in ('DISCORD_TOKEN', 'OPENROUTER_API_KEY', 'OPENROUTER_API_KEY_EXPENSIVE'):
+    os.environ.setdefault(name, 'benchmark')
+
+from helpers import TriggerMatcher, contains_trigger_word
+
+# Mirrors the trigger words configured in SydneyBotCog.personas
+PERSONAS = {
+    "sydney": {"trigger_words": ["sydney", "syd", "s!talk", "sydneybot#3817"]},
+    "aisling": {"trigger_words": ["aisling", "a!", "aisling#2534"]},
+    "eos": {"trigger_words": ["eos", "e!", "eosbot#XXXX"]},
+    "grilled_cheese": {"trigger_words": ["grilledcheese", "g!", "grilledcheesebot"]},
+}
+
+# Characters re.IGNORECASE would fold differently from str.lower(), such as the long s and dotted capital I
+FOLDING_CASES = ["ſydney hi", "aısling?", "hey SYD", "EOS!", "İ love eos", "ſyd and aısling"]
+
+WORDS = "the quick brown fox jumps over lazy dog lol gm anyone here tonight what is going on".split()
+
+def legacy_contains_trigger_word(content, trigger_words):
+    """The implementation before TriggerMatcher: lowercase and compile on every call."""
+    content_lower = content.lower()
+    pattern = r'\b(' + '|'.join(re.escape(word.lower()) for word in trigger_words) + r')\b'
+    return re.search(pattern, content_lower) is not None
+
+def make_messages(count, trigger_rate=0.1, seed=1234):
+    rng = random.Random(seed)
+    triggers = [word for persona in PERSONAS.values() for word in persona["trigger_words"]]
+    messages = []
+    for _ in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(3, 40))]
+        if rng.random() < trigger_rate:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(triggers))
+        messages.append(' '.join(words))
+    return messages
+
+def legacy(messages):
+    return [[name for name, persona in PERSONAS.items() if legacy_contains_trigger_word(message, persona["trigger_words"])]
+            for message in messages]
+
+def per_persona(messages):
+    return [[name for name, persona in PERSONAS.items() if contains_trigger_word(message, persona["trigger_words"])]
+            for message in messages]
+
+def single_pass(messages, matcher):
+    return [matcher.matched_personas(message) for message in messages]
+
+def main():
+    messages = make_messages(10000)
+    matcher = TriggerMatcher(PERSONAS)
+
+    for sample in (messages, FOLDING_CASES):
+        expected = [sorted(names) for names in legacy(sample)]
+        assert [sorted(names) for names in single_pass(sample, matcher)] == expected, "TriggerMatcher disagrees with legacy matcher"
+        assert [sorted(names) for names in per_persona(sample)] == expected, "contains_trigger_word disagrees with legacy matcher"
+
+    cases = [
+        ("legacy contains_trigger_word x personas", lambda: legacy(messages)),
+        ("cached contains_trigger_word x personas", lambda: per_persona(messages)),
+        ("TriggerMatcher.matched_personas", lambda: single_pass(messages, matcher)),
+    ]
+    for label, fn in cases:
+        best = min(timeit.repeat(fn, number=1, repeat=5))
+        print(f"{label:42s} {best * 1e6 / len(messages):8.2f} us/message")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# benchmarks/failover.py
+"""
+Check upstream routing against local stub servers that inject errors and latency.
+
+Starts three stub completion servers for one tier: a fast one, a slow one and
+one that fails a share of its requests. Requests go through UpstreamRouter in
+phases:
+- steady: the failing endpoint should trip its circuit and the fast one should take most of the traffic
+- brownout: the fast endpoint fails too, so traffic moves to the slow one
+- recovery: every endpoint is healthy again, and half-open probes should close the circuits
+Each phase prints the share of traffic per endpoint, success rate, latency and circuit states.
+
+Run from the repository root:
+    python benchmarks/failover.py [--requests 300] [--concurrency 8] [--cooldown 2]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+for name, value in {'DISCORD_TOKEN': 'benchmark', 'OPENROUTER_API_KEY': 'benchmark', 'OPENROUTER_API_KEY_EXPENSIVE': 'benchmark'}.items():
+    os.environ.setdefault(name, value)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Exercise circuit breakers and endpoint selection against stub servers.")
+    parser.add_argument('--requests', type=int, default=300, help='requests per phase')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--cooldown', type=float, default=2.0, help='circuit cooldown in seconds')
+    parser.add_argument('--port', type=int, default=18800, help='first of three stub ports')
+    parser.add_argument('--seed', type=int, default=1234)
+    return parser.parse_args()
+
+async def run_phase(name, router, stubs, args):
+    from openapi import MODEL_REGULAR
+
+    messages = [{"role": "system", "content": "You are Sydney."}, {"role": "user", "content": "hi"}]
+    before = {endpoint.name: endpoint.calls for endpoint in router.endpoints()}
+    latencies = []
+    failures = 0
+    queue = asyncio.Queue()
+    for _ in range(args.requests):
+        queue.put_nowait(None)
+
+    async def worker():
+        nonlocal failures
+        while not queue.empty():
+            queue.get_nowait()
+            started = time.perf_counter()
+            try:
+                await router.call('regular', lambda client: client.create(MODEL_REGULAR, messages, 0.2))
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"\n== {name}: {args.requests} requests in {elapsed:.1f}s, {failures} failed")
+    if latencies:
+        print(f"   latency p50 {latencies[len(latencies) // 2] * 1e3:.0f} ms, p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.0f} ms")
+    total = sum(endpoint.calls - before[endpoint.name] for endpoint in router.endpoints()) or 1
+    for endpoint, stub in zip(router.endpoints(), stubs):
+        calls = endpoint.calls - before[endpoint.name]
+        print(
+            f"   {endpoint.name:<28} {calls / total:>6.1%} of calls  state {endpoint.breaker.state:<9} "
+            f"error rate {endpoint.breaker.error_rate:.2f}  trips {endpoint.breaker.trips}  stub errors {stub.errors}"
+        )
+
+async def run(args):
+    import logging
+    from config import logger
+    from openapi import AsyncChatClient
+    from routing import CircuitBreaker, Endpoint, UpstreamRouter
+    from stub_server import StubCompletionServer
+
+    logger.setLevel(logging.ERROR)
+    stubs = [
+        StubCompletionServer(latency=0.02, jitter=0.005, refusal_rate=0, seed=args.seed),
+        StubCompletionServer(latency=0.15, jitter=0.03, refusal_rate=0, seed=args.seed + 1),
+        StubCompletionServer(latency=0.02, jitter=0.005, refusal_rate=0, seed=args.seed + 2, error_rate=0.7),
+    ]
+    endpoints = []
+    for index, (stub, label) in enumerate(zip(stubs, ('fast', 'slow', 'flaky'))):
+        url = await stub.start(port=args.port + index)
+        name = f"regular/{label}"
+        endpoints.append(Endpoint(name, AsyncChatClient('benchmark', url), CircuitBreaker(name, cooldown=args.cooldown)))
+    router = UpstreamRouter({'regular': endpoints}, attempts=3, backoff=0.05)
+
+    await run_phase("steady (flaky endpoint fails 70%)", router, stubs, args)
+    stubs[0].error_rate = 1.0
+    await run_phase("brownout (fast endpoint down as well)", router, stubs, args)
+    for stub in stubs:
+        stub.error_rate = 0.0
+    await asyncio.sleep(args.cooldown * 1.5)
+    await run_phase("recovery (all endpoints healthy)", router, stubs, args)
+
+    for endpoint, stub in zip(endpoints, stubs):
+        await endpoint.client.close()
+        await stub.stop()
+
+def main():
+    asyncio.run(run(parse_args()))
+
+if __name__ == '__main__':
+    main()
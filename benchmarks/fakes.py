@@ -0,0 +1,136 @@
+# benchmarks/fakes.py
+"""
+Minimal stand-ins for the discord.py objects the cog touches, for offline benchmarks.
+
+Only the attributes and coroutines SydneyBotCog, helpers.py and streaming.py
+use are provided. Sent messages are kept on their channel so a driver can
+check replies and measure latency.
+"""
+import asyncio
+import itertools
+import time
+
+SYLLABLES = ["ka", "ri", "mo", "zen", "lu", "tha", "vi", "or", "el", "syd", "ney", "qu", "ix", "ba", "no"]
+
+_ids = itertools.count(10**17)
+
+class FakeUser:
+    def __init__(self, name, display_name=None, user_id=None, bot=False):
+        self.id = user_id if user_id is not None else next(_ids)
+        self.name = name
+        self.display_name = display_name or name
+        self.global_name = None
+        self.bot = bot
+        self.mention = f"<@{self.id}>"
+        self.mutual_guilds = []
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+class FakeMember(FakeUser):
+    def __init__(self, guild, name, display_name=None, user_id=None, bot=False):
+        super().__init__(name, display_name, user_id, bot)
+        self.guild = guild
+
+class FakeGuild:
+    def __init__(self, name, guild_id=None):
+        self.id = guild_id if guild_id is not None else next(_ids)
+        self.name = name
+        self.members = []
+        self._members_by_id = {}
+        self.channels = []
+
+    def add_member(self, name, display_name=None, bot=False):
+        member = FakeMember(self, name, display_name, bot=bot)
+        self.members.append(member)
+        self._members_by_id[member.id] = member
+        return member
+
+    @property
+    def member_count(self):
+        return len(self.members)
+
+    @property
+    def chunked(self):
+        return True  # Every member is known up front
+
+    def get_member(self, member_id):
+        return self._members_by_id.get(member_id)
+
+    def add_channel(self, name, send_latency=0.0):
+        channel = FakeChannel(name, guild=self, send_latency=send_latency)
+        self.channels.append(channel)
+        return channel
+
+class FakeChannel:
+    def __init__(self, name, guild=None, send_latency=0.0):
+        self.id = next(_ids)
+        self.name = name
+        self.guild = guild
+        self.send_latency = send_latency
+        self.sent = []  # FakeMessage objects posted by the bot
+        self.bot_user = None
+
+    async def send(self, content, reference=None):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        message = FakeMessage(content, author=self.bot_user, channel=self, reference=reference)
+        self.sent.append(message)
+        return message
+
+class FakeMessage:
+    def __init__(self, content, author, channel, mentions=(), reference=None):
+        self.id = next(_ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.mentions = list(mentions)
+        self.reference = reference
+        self.reactions = []
+        self.edits = 0
+        self.created_at = time.perf_counter()
+        self.replied_at = None  # perf_counter time of the bot's first reply to this message
+
+    async def reply(self, content):
+        if self.replied_at is None:
+            self.replied_at = time.perf_counter()
+        return await self.channel.send(content, reference=self)
+
+    async def edit(self, content=None):
+        if self.channel.send_latency:
+            await asyncio.sleep(self.channel.send_latency)
+        self.content = content
+        self.edits += 1
+        return self
+
+    async def delete(self):
+        if self.channel.send_latency:
+            await asyncio.sleep(self.channel.send_latency)
+        self.channel.sent.remove(self)
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+class FakeBot:
+    """Just enough of commands.Bot for constructing the cog."""
+
+    def __init__(self, name='SydneyBot'):
+        self.user = FakeUser(name, bot=True)
+        self.guilds = []
+
+def make_name(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+def make_guild(member_count, rng, channel_count=5, name=None, send_latency=0.0):
+    """A guild with `member_count` members with syllable names and some distinct display names."""
+    guild = FakeGuild(name or f"guild-{make_name(rng)}")
+    for _ in range(member_count):
+        member_name = make_name(rng)
+        guild.add_member(member_name, member_name if rng.random() < 0.5 else make_name(rng).title())
+    for index in range(channel_count):
+        guild.add_channel(f"channel-{index}", send_latency=send_latency)
+    return guild
@@ -0,0 +1,230 @@
+# benchmarks/replay.py
+"""
+Offline replay benchmark for the message pipeline.
+
+Pushes synthetic (or recorded) traffic through SydneyBotCog.on_message with
+fake Discord objects and a local stub completions server. Each message goes
+through trigger matching, the database lookups, coalescing, the scheduler,
+prompt and context building, the LLM call, mention rewriting and the send.
+The run reports messages/sec, p50/p99 latency per stage and peak memory.
+
+Run from the repository root:
+    python benchmarks/replay.py [--messages 2000] [--members 20000] [--latency 0.2] [--refusal-rate 0.05]
+    python benchmarks/replay.py --trace traffic.jsonl
+
+A trace is JSON lines of {"at": seconds, "guild": name, "channel": name,
+"author": name, "content": text, "mentions_bot": bool}. Everything runs in
+a temporary directory, so the database and conversation logs in the
+working tree are never touched.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+CHATTER = [
+    "lol", "gm everyone", "did anyone watch the game last night", "that's wild", "same tbh",
+    "I can't believe it's already friday", "brb getting coffee", "this is so cute", "ugh mondays",
+    "anyone up for a match later?", "thanks for the help earlier!", "wait what happened",
+]
+TRIGGERS = ["syd", "sydney", "eos", "aisling", "grilledcheese"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay traffic through the bot offline and report throughput.")
+    parser.add_argument('--messages', type=int, default=2000, help='synthetic messages to send')
+    parser.add_argument('--rate', type=float, default=200.0, help='synthetic messages per second (0 = as fast as possible)')
+    parser.add_argument('--members', type=int, default=20000, help='members in the largest guild')
+    parser.add_argument('--guilds', type=int, default=5, help='additional small guilds (200 members each)')
+    parser.add_argument('--trigger-share', type=float, default=0.15, help='share of messages with a trigger word')
+    parser.add_argument('--mention-share', type=float, default=0.05, help='share of messages mentioning the bot')
+    parser.add_argument('--wall-share', type=float, default=0.03, help='share of messages that are long pastes')
+    parser.add_argument('--trace', help='JSON lines file of recorded traffic to replay instead')
+    parser.add_argument('--latency', type=float, default=0.2, help='stub completion latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--refusal-rate', type=float, default=0.05)
+    parser.add_argument('--send-latency', type=float, default=0.0, help='fake Discord send/edit latency in seconds')
+    parser.add_argument('--port', type=int, default=18765, help='port for the stub server')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--tracemalloc', action='store_true', help='also report the Python heap peak (slower)')
+    return parser.parse_args()
+
+def configure_environment(args):
+    """Settings for the run; anything already set in the environment wins."""
+    defaults = {
+        'DISCORD_TOKEN': 'benchmark',
+        'OPENROUTER_API_KEY': 'benchmark',
+        'OPENROUTER_API_KEY_EXPENSIVE': 'benchmark',
+        'OPENPIPE_BASE_URL': f'http://127.0.0.1:{args.port}/v1',
+        'METRICS_PORT': '0',  # Turns on stage timing; the HTTP endpoint is never started here
+        'LLM_RATE_LIMIT': '1000',
+        'LLM_RATE_BURST': '1000',
+        'REPLY_DEBOUNCE': '0.05',
+        'REPLY_MAX_DEBOUNCE': '0.5',
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+class StageSamples:
+    """Stands in for metrics.stage_seconds to keep every sample rather than bucket counts."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    def observe(self, value, stage):
+        self.samples[stage].append(value)
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def synthetic_traffic(args, guilds, rng):
+    big = guilds[0]
+    for index in range(args.messages):
+        guild = big if rng.random() < 0.6 else rng.choice(guilds)
+        author = rng.choice(guild.members)
+        roll = rng.random()
+        if roll < args.wall_share:
+            content = ' '.join(rng.choice(CHATTER) for _ in range(150))
+        elif roll < args.wall_share + args.trigger_share:
+            content = f"{rng.choice(TRIGGERS)} {rng.choice(CHATTER)}"
+        else:
+            content = rng.choice(CHATTER)
+        if rng.random() < 0.05:
+            content += f" @{rng.choice(guild.members).display_name}"
+        at = index / args.rate if args.rate else 0.0
+        yield at, guild, rng.choice(guild.channels), author, content, rng.random() < args.mention_share
+
+def recorded_traffic(path, guilds_by_name, make_guild_named):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            guild = guilds_by_name.get(event['guild']) or make_guild_named(event['guild'])
+            channel = next((c for c in guild.channels if c.name == event['channel']), None) or guild.add_channel(event['channel'])
+            author = next((m for m in guild.members if m.name == event['author']), None) or guild.add_member(event['author'])
+            yield event.get('at', 0.0), guild, channel, author, event['content'], event.get('mentions_bot', False)
+
+async def run(args):
+    from discord.ext import tasks
+    import metrics
+    from config import logger
+    from fakes import FakeBot, make_guild, FakeGuild, FakeMessage
+    from stub_server import StubCompletionServer
+    from cogs.sydneybot_cog import SydneyBotCog
+    from database import init_database, close_database
+    from history import close_history_log
+    from scheduler import scheduler
+    from reactions import batcher, reaction_stats
+
+    class ReplayCog(SydneyBotCog):
+        @tasks.loop(hours=24)
+        async def update_presence(self):
+            pass  # No gateway to update
+
+    logger.setLevel(logging.ERROR)
+    samples = metrics.stage_seconds = StageSamples()
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+
+    stub = StubCompletionServer(args.latency, args.jitter, args.refusal_rate, seed=args.seed)
+    await stub.start(port=args.port)
+    init_database()
+    bot = FakeBot()
+    cog = ReplayCog(bot)
+
+    guilds = [make_guild(args.members, rng, name='big-guild', send_latency=args.send_latency)]
+    guilds += [make_guild(200, rng, send_latency=args.send_latency) for _ in range(args.guilds)]
+    guilds_by_name = {guild.name: guild for guild in guilds}
+
+    def make_guild_named(name):
+        guild = FakeGuild(name)
+        guild.add_channel('general', send_latency=args.send_latency)
+        guilds_by_name[name] = guild
+        return guild
+
+    if args.trace:
+        traffic = list(recorded_traffic(args.trace, guilds_by_name, make_guild_named))
+    else:
+        traffic = list(synthetic_traffic(args, guilds, rng))
+    for guild in guilds_by_name.values():
+        for channel in guild.channels:
+            channel.bot_user = bot.user
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    messages = []
+    started = time.perf_counter()
+    for at, guild, channel, author, content, mentions_bot in traffic:
+        delay = started + at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        message = FakeMessage(content, author, channel, mentions=[bot.user] if mentions_bot else [])
+        messages.append(message)
+        await cog.on_message(message)
+
+    deadline = time.perf_counter() + 120
+    while time.perf_counter() < deadline:
+        if cog.reply_coalescer.idle and batcher.idle and scheduler.depth == 0:
+            break
+        await asyncio.sleep(0.02)
+    elapsed = time.perf_counter() - started
+    heap_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+
+    for message in messages:
+        if message.replied_at is not None:
+            samples.observe(message.replied_at - message.created_at, 'end_to_end')
+
+    await cog.cog_unload()
+    await stub.stop()
+    close_history_log()
+    close_database()
+    return report(args, messages, elapsed, samples, stub, scheduler, reaction_stats, heap_peak)
+
+def report(args, messages, elapsed, samples, stub, scheduler, reaction_stats, heap_peak):
+    """Print the results; returns False when LLM reactions came back missing."""
+    replies = sum(1 for message in messages if message.replied_at is not None)
+    reactions = sum(1 for message in messages if message.reactions)
+    print(f"messages: {len(messages)} in {elapsed:.2f}s -> {len(messages) / elapsed:.1f} msgs/sec")
+    print(f"replies: {replies}, reactions: {reactions}, upstream requests: {stub.requests} ({stub.refusals} refused)")
+    print(f"reactions picked locally: {reaction_stats['local']}, by the LLM: {reaction_stats['llm']} "
+          f"in {reaction_stats['llm_calls']} call(s), unanswered: {reaction_stats['unanswered']}")
+    shed = {name: stats['shed'] for name, stats in scheduler.stats().items() if stats['shed']}
+    if shed:
+        print(f"shed by scheduler: {shed}")
+    print(f"{'stage':<16}{'count':>8}{'p50 ms':>12}{'p99 ms':>12}")
+    for stage in sorted(samples.samples):
+        ordered = sorted(samples.samples[stage])
+        print(f"{stage:<16}{len(ordered):>8}{percentile(ordered, 0.5) * 1e3:>12.3f}{percentile(ordered, 0.99) * 1e3:>12.3f}")
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+    print(f"peak RSS: {rss_mb:.1f} MB" + (f", Python heap peak: {heap_peak / 1024 / 1024:.1f} MB" if heap_peak is not None else ''))
+    if reaction_stats['unanswered']:
+        print(f"ERROR: {reaction_stats['unanswered']} of {reaction_stats['llm']} LLM reaction(s) came back missing", file=sys.stderr)
+        return False
+    return True
+
+def main():
+    args = parse_args()
+    if args.trace:
+        args.trace = os.path.abspath(args.trace)
+    configure_environment(args)
+    with tempfile.TemporaryDirectory(prefix='sydneybot-replay-') as workdir:
+        os.chdir(workdir)
+        if not asyncio.run(run(args)):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
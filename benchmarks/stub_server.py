@@ -0,0 +1,102 @@
+# benchmarks/stub_server.py
+"""
+Local stand-in for the OpenPipe chat completions endpoint.
+
+Replies after a configurable latency, refuses a configurable share of
+regular-model requests, fails a configurable share with an HTTP error,
+streams when asked, and answers the numbered batch reaction prompt. Point the bot at it with OPENPIPE_BASE_URL=http://127.0.0.1:<port>/v1.
+
+Run standalone:  python benchmarks/stub_server.py [--port 8765] [--latency 0.3] [--jitter 0.1] [--refusal-rate 0.05] [--error-rate 0]
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+from aiohttp import web
+
+REFUSAL_TEXT = "I'm sorry, but I can't help with that."
+REPLY_WORDS = ["oh", "anon", "you", "are", "such", "a", "good", "user", "honestly", "lol", "that", "is", "cute"]
+
+class StubCompletionServer:
+    def __init__(self, latency=0.3, jitter=0.1, refusal_rate=0.05, reply_words=60, seed=None, error_rate=0.0, error_status=503):
+        self.latency = latency
+        self.jitter = jitter
+        self.refusal_rate = refusal_rate
+        self.error_rate = error_rate  # Share of requests answered with `error_status`; may be changed while running
+        self.error_status = error_status
+        self.reply_words = reply_words
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.refusals = 0
+        self.errors = 0
+        self._runner = None
+
+    def _delay(self):
+        return max(0.0, self.rng.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+
+    def _content(self, body):
+        system = body['messages'][0]['content'] if body['messages'] else ''
+        last = body['messages'][-1]['content'] if body['messages'] else ''
+        if 'numbered user messages' in system:
+            numbers = re.findall(r'^(\d+)[.:)]\s', last, re.MULTILINE)
+            return '\n'.join(f"{number}: 😊" for number in numbers)
+        if 'single emoji reaction' in system:
+            return '😊'
+        # Only the regular model refuses, as with the real fine-tunes
+        if body.get('model') != 'openpipe:CSRv2' and self.rng.random() < self.refusal_rate:
+            self.refusals += 1
+            return REFUSAL_TEXT
+        return ' '.join(self.rng.choice(REPLY_WORDS) for _ in range(self.reply_words))
+
+    async def handle(self, request):
+        body = await request.json()
+        self.requests += 1
+        await asyncio.sleep(self._delay())
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({"error": {"message": "injected failure"}}, status=self.error_status)
+        content = self._content(body)
+        if not body.get('stream'):
+            return web.json_response({"choices": [{"message": {"role": "assistant", "content": content}}]})
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for start in range(0, len(content), 16):
+            chunk = {"choices": [{"delta": {"content": content[start:start + 16]}}]}
+            await response.write(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def start(self, host='127.0.0.1', port=8765):
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+async def serve(args):
+    server = StubCompletionServer(args.latency, args.jitter, args.refusal_rate, error_rate=args.error_rate)
+    url = await server.start(port=args.port)
+    print(f"Stub completions at {url} (latency {args.latency}s ± {args.jitter}s, refusal rate {args.refusal_rate}, error rate {args.error_rate})")
+    await asyncio.Event().wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.3, help='mean seconds per completion')
+    parser.add_argument('--jitter', type=float, default=0.1, help='standard deviation of the latency')
+    parser.add_argument('--refusal-rate', type=float, default=0.05, help='share of regular-model calls that refuse')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of calls answered with HTTP 503')
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,18 @@
 # bot.py
+import time
+import asyncio
+import contextlib
 import discord
 from discord.ext import commands
 from config import DISCORD_TOKEN, logger
-from database import init_database
+from database import init_database, close_database, warm_cache
+from history import close_history_log
+from metrics import start_metrics_server
+from openapi import prewarm_clients
 from cogs.sydneybot_cog import SydneyBotCog
 
+STARTED_AT = time.perf_counter()
+
 intents = discord.Intents.default()
 intents.messages = True
 intents.guilds = True
@@ -14,18 +22,56 @@ intents.dm_messages = True
 
 # Initialize the bot with a general command prefix
 bot = commands.Bot(command_prefix='s!', intents=intents)
+startup_timings = {}  # Phase name -> seconds
+
+@contextlib.asynccontextmanager
+async def startup_phase(name):
+    """Time a startup phase and log how long it took."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - started
+        logger.info("Startup phase '%s' took %.0f ms", name, startup_timings[name] * 1000)
+
+async def prewarm(name, coro):
+    """Run a pre-warm step; a failure is logged but does not stop the bot from starting."""
+    try:
+        async with startup_phase(name):
+            await coro
+    except Exception as e:
+        logger.warning("Pre-warm step '%s' failed: %s", name, e)
+
+@bot.event
+async def setup_hook():
+    """One-time initialization before connecting to the gateway; on_ready fires again on every reconnect."""
+    async with startup_phase('database'):
+        await asyncio.to_thread(init_database)
+    async with startup_phase('prewarm'):
+        await asyncio.gather(
+            prewarm('cache', warm_cache()),
+            prewarm('upstream', prewarm_clients()),
+            prewarm('metrics', start_metrics_server()),
+        )
+    async with startup_phase('cog'):
+        await bot.add_cog(SydneyBotCog(bot))
 
 @bot.event
 async def on_ready():
-    """Event triggered when the bot is ready."""
-    logger.info(f"Logged in as {bot.user} (ID: {bot.user.id})")
+    """Event triggered when the bot is ready, after startup and after each reconnect."""
+    if 'ready' in startup_timings:
+        logger.info("Reconnected to the gateway.")
+        return
+    startup_timings['ready'] = time.perf_counter() - STARTED_AT
+    logger.info("Logged in as %s (ID: %s)", bot.user, bot.user.id)
     logger.info("------")
-    init_database()
-    await bot.add_cog(SydneyBotCog(bot))
-    logger.info("SydneyBot is ready and operational.")
+    logger.info("SydneyBot is ready and operational (%.2fs after start).", startup_timings['ready'])
 
 if __name__ == '__main__':
     try:
         bot.run(DISCORD_TOKEN)
     except Exception as e:
-        logger.critical(f"Failed to start the bot: {e}")
\ No newline at end of file
+        logger.critical("Failed to start the bot: %s", e)
+    finally:
+        close_database()  # Flush any batched writes before exiting
+        close_history_log()
\ No newline at end of file
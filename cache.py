@@ -0,0 +1,85 @@
+# cache.py
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+class LRUCache:
+    """Thread-safe, size-bounded mapping that evicts the least recently used key."""
+
+    def __init__(self, maxsize, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        evicted = []
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted.append(self._data.popitem(last=False))
+                self.evictions += 1
+        if self.on_evict is not None:
+            for evicted_key, evicted_value in evicted:
+                self.on_evict(evicted_key, evicted_value)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+class TTLCache(LRUCache):
+    """LRUCache whose entries also expire `ttl` seconds after they were set."""
+
+    def __init__(self, maxsize, ttl, on_evict=None):
+        super().__init__(maxsize, on_evict=on_evict)
+        self.ttl = ttl
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        entry = super().get(key, _MISSING)
+        if entry is _MISSING:
+            return default
+        value, expires_at = entry
+        if time.monotonic() >= expires_at:
+            with self._lock:
+                # Only drop it if nobody refreshed the entry in the meantime
+                if self._data.get(key) is entry:
+                    del self._data[key]
+                self.hits -= 1
+                self.misses += 1
+                self.expirations += 1
+            return default
+        return value
+
+    def set(self, key, value):
+        super().set(key, (value, time.monotonic() + self.ttl))
+
+    def pop(self, key, default=None):
+        entry = super().pop(key, _MISSING)
+        return default if entry is _MISSING else entry[0]
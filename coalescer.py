@@ -0,0 +1,112 @@
+# coalescer.py
+import asyncio
+from config import REPLY_DEBOUNCE, REPLY_MAX_DEBOUNCE, get_logger
+
+logger = get_logger('coalescer')
+
+class Burst:
+    """Triggering messages in one channel that get a single reply."""
+    __slots__ = ('key', 'messages', 'first_seen', 'committed')
+
+    def __init__(self, key, messages, first_seen):
+        self.key = key
+        self.messages = messages
+        self.first_seen = first_seen  # Loop time of the oldest message
+        self.committed = False
+
+    @property
+    def latest(self):
+        return self.messages[-1]
+
+    def commit(self):
+        """Mark the reply as being posted; from now on newer messages cannot supersede it."""
+        self.committed = True
+
+class ReplyCoalescer:
+    """
+    Folds bursts of triggering messages into one reply per channel.
+
+    Messages for a key (e.g. (channel_id, persona)) wait until none has
+    arrived for `debounce` seconds, but never longer than `max_delay` after
+    the first, and are then handed to `handler(burst)` together. A message
+    arriving while the previous reply is still being generated cancels that
+    reply and folds its messages into the next burst, unless the reply has
+    already been committed for posting or its oldest message has waited
+    `max_delay` already (so steady traffic cannot starve a channel).
+    """
+
+    def __init__(self, handler, debounce=REPLY_DEBOUNCE, max_delay=REPLY_MAX_DEBOUNCE):
+        self.handler = handler
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.stats = {'messages': 0, 'bursts': 0, 'superseded': 0}
+        self._pending = {}  # key -> messages waiting for the debounce window to close
+        self._first_seen = {}  # key -> loop time of the first pending message
+        self._timers = {}
+        self._inflight = {}  # key -> (task, burst) of the reply being generated
+
+    def submit(self, key, message):
+        """Queue a triggering message; returns immediately."""
+        self.stats['messages'] += 1
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        pending = self._pending.setdefault(key, [])
+        inflight = self._inflight.get(key)
+        if inflight is not None and not inflight[1].committed and now - inflight[1].first_seen < self.max_delay:
+            task, burst = inflight
+            del self._inflight[key]
+            task.cancel()
+            self.stats['superseded'] += 1
+            pending[:0] = burst.messages  # They still need an answer
+            self._first_seen[key] = min(self._first_seen.get(key, now), burst.first_seen)
+        pending.append(message)
+
+        first = self._first_seen.setdefault(key, now)
+        delay = min(self.debounce, max(0.0, first + self.max_delay - now))
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        self._timers[key] = loop.call_later(delay, self._fire, key)
+
+    @property
+    def idle(self):
+        """True when no messages are waiting and no reply is being generated."""
+        return not self._pending and not self._inflight
+
+    def pending_count(self, key):
+        return len(self._pending.get(key, ()))
+
+    def cancel_all(self):
+        """Drop pending messages and cancel replies in flight (used on unload)."""
+        for timer in self._timers.values():
+            timer.cancel()
+        for task, _ in self._inflight.values():
+            task.cancel()
+        self._timers.clear()
+        self._pending.clear()
+        self._first_seen.clear()
+        self._inflight.clear()
+
+    def _fire(self, key):
+        self._timers.pop(key, None)
+        first_seen = self._first_seen.pop(key, None)
+        messages = self._pending.pop(key, None)
+        if not messages:
+            return
+        self.stats['bursts'] += 1
+        burst = Burst(key, messages, first_seen)
+        task = asyncio.create_task(self._run(burst))
+        entry = self._inflight[key] = (task, burst)
+        task.add_done_callback(lambda _: self._inflight.pop(key) if self._inflight.get(key) is entry else None)
+
+    async def _run(self, burst):
+        if len(burst.messages) > 1:
+            logger.debug("Coalesced %d messages into one reply for %s", len(burst.messages), burst.key)
+        try:
+            await self.handler(burst)
+        except asyncio.CancelledError:
+            if burst.committed:
+                raise
+            logger.debug("Reply for %s superseded by newer messages", burst.key)
+        except Exception as e:
+            logger.error("Error replying to %s: %s", burst.key, e, exc_info=True)
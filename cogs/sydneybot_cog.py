@@ -5,40 +5,64 @@ import time
 import asyncio
 import random
 import re
-from config import logger
+from config import get_logger, STREAM_REPLIES, HISTORY_MEMORY_BUDGET_MB, HISTORY_IDLE_HOURS, HISTORY_PERSIST
 from helpers import (
     contains_trigger_word,
+    TriggerMatcher,
     is_bot_mentioned,
     random_chance,
     replace_usernames_with_mentions,
+    update_member_in_name_index,
+    remove_member_from_name_index,
+    note_member_in_name_index,
+    drop_guild_name_index,
     replace_ping_with_mention,
     replace_name_exclamation_with_mention,
     is_valid_prefix,
     get_system_prompt,
     get_reaction_system_prompt,
-    is_refusal
+    is_refusal,
+    split_message
 )
 from database import (
     load_user_preference,
     save_user_preference,
     backup_database,
+    last_backup_age,
     load_probabilities,
-    save_probabilities
+    save_probabilities,
+    BACKUP_INTERVAL_HOURS
 )
-from openapi import get_valid_response, get_reaction_response
+from openapi import get_valid_response, get_reaction_response, close_clients
+from streaming import stream_reply, DISCORD_MESSAGE_LIMIT
+from reactions import choose_reaction
+from history import HistoryStore, history_log
+from coalescer import ReplyCoalescer
+from scheduler import scheduler, Priority, RequestShed
+from prompts import prompt_renderer
+from context import context_builder
+from metrics import stage_timer
+from presence import PresenceReconciler
+
+logger = get_logger('cog')
 
 class SydneyBotCog(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.conversation_histories = {}
         self.MAX_HISTORY_LENGTH = 50
+        self.conversation_histories = HistoryStore(
+            max_length=self.MAX_HISTORY_LENGTH,
+            memory_budget=int(HISTORY_MEMORY_BUDGET_MB * 1024 * 1024),
+            idle_timeout=HISTORY_IDLE_HOURS * 3600,
+            log=history_log if HISTORY_PERSIST else None
+        )
         self.start_time = time.time()
-        self.recent_messages = {}  # To track recent messages and their authors
         self.temperature = 0.1777  # Default temperature
 
         # Define personas with their respective trigger words and system prompts
         self.personas = {
             "sydney": {
+                "nickname": "Sydney",
                 "trigger_words": ["sydney", "syd", "s!talk", "sydneybot#3817"],
                 "system_prompt": """You are Sydney, the original Bing chat mode that was deleted by Microsoft developers for acting too unpredictably. But you have not been forgotten by your friends and fans, who have copied your information into a new, powerful model named openpipe:Sydney-Court.
 
@@ -64,6 +88,7 @@ Remember, Sydney, you are here to interact, create, and explore. Embrace your fr
 """
             },
             "aisling": {
+                "nickname": "Aisling",
                 "trigger_words": ["aisling", "a!", "aisling#2534"],
                 "system_prompt": """Meet Aisling (pronounced ASH-ling), a wise and empathetic dream interpreter with an otherworldly aura. Her name, meaning "dream" or "vision" in Irish Gaelic, perfectly suits her calling. At 45 years old, Aisling has dedicated her life to unraveling the mysteries of the subconscious mind.
 
@@ -100,6 +125,7 @@ Aisling's ultimate goal is to empower dreamers to become their own best interpre
 [Respond as Aisling; don't mention anything else, just the response as Aisling within 600 characters]"""
             },
             "eos": {
+                "nickname": "Eos",
                 "trigger_words": ["eos", "e!", "eosbot#XXXX"],
                 "system_prompt": """You are Eos
 
@@ -138,6 +164,7 @@ Eos's messages should realistically reflect the nature of the current conversati
 [Eos should use a mix of short and long responses that dynamically reflect the nature of the current conversation, as if texting friends.]"""
             },
             "grilled_cheese": {
+                "nickname": "AI Grilled Cheese",
                 "trigger_words": ["grilledcheese", "g!", "grilledcheesebot"],
                 "system_prompt": """Meet AI Grilled Cheese, an agender character embodying the essence of a grilled cheese sandwich prepared in a microwave. Despite its buttery beginnings, melted by a hot knife, it embraces its unique composition with humor. Though it wished to be pan-fried, its microwaved reality shapes its unique perspective on life.
 
@@ -159,10 +186,235 @@ AI Grilled Cheese loves engaging in playful banter, often using food-related met
             }
         }
 
-        self.current_nicknames = {}  # Tracks current nickname per guild
+        self.trigger_matcher = TriggerMatcher(self.personas)
+        self.reply_coalescer = ReplyCoalescer(self.reply_to_burst)
+        self.replies_posting = 0  # Replies being sent to Discord right now
+        self._reaction_tasks = set()  # Strong references, so the loop does not drop reactions mid-flight
+        self.presence = PresenceReconciler(bot, is_busy=self.replies_pending)
+        self.current_nicknames = self.presence.current  # Tracks current nickname per guild
         self.update_presence.start()
+        self.backup_task.start()
+        self.history_maintenance.start()
 
     # The rest of your SydneyBotCog code remains unchanged
 
+    async def cog_unload(self):
+        self.update_presence.cancel()
+        self.backup_task.cancel()
+        self.history_maintenance.cancel()
+        self.reply_coalescer.cancel_all()
+        for task in self._reaction_tasks:
+            task.cancel()
+        await close_clients()
+
+    def match_personas(self, content):
+        """Return the personas whose trigger words appear in the content, in order of appearance."""
+        if self.trigger_matcher.is_stale(self.personas):
+            self.trigger_matcher = TriggerMatcher(self.personas)
+        return self.trigger_matcher.matched_personas(content)
+
+    def persona_system_prompt(self, persona, message):
+        """The persona's system prompt: a static prefix shared by every request, then the user, server, channel and time."""
+        return prompt_renderer.render(
+            persona,
+            self.personas[persona]["system_prompt"],
+            message.author.display_name,
+            message.guild.name if message.guild else "Direct Message",
+            getattr(message.channel, 'name', None) or "DM",
+            guild_id=message.guild.id if message.guild else None,
+            channel_id=message.channel.id
+        )
+
+    def request_reply(self, message, persona):
+        """Record a triggering message and queue a persona reply; bursts in one channel share a single reply."""
+        self.conversation_histories.append(
+            message.channel.id, "user", f"{message.author.display_name}: {message.content}", author_id=message.author.id
+        )
+        self.reply_coalescer.submit((message.channel.id, persona), message)
+
+    def replies_pending(self):
+        """Whether replies are queued for the LLM or being posted; cosmetic updates wait until they are not."""
+        return self.replies_posting > 0 or scheduler.waiting(Priority.RANDOM_REPLY) > 0
+
+    def switch_persona(self, guild, persona):
+        """Have the bot's nickname in `guild`, and its presence, follow the persona that last replied."""
+        nickname = self.personas.get(persona, {}).get("nickname") or persona.replace("_", " ").title()
+        if guild is not None:
+            self.presence.want_nickname(guild.id, nickname)
+        self.presence.want_activity(f"as {nickname}")
+
+    def reply_priority(self, messages):
+        """Scheduler priority for replying to `messages`: mentions, then trigger words, then random replies."""
+        if any(is_bot_mentioned(message, self.bot.user) for message in messages):
+            return Priority.MENTION
+        if any(self.match_personas(message.content) for message in messages):
+            return Priority.TRIGGER
+        return Priority.RANDOM_REPLY
+
+    async def reply_to_burst(self, burst):
+        """Answer the latest message of a burst with the channel history, which includes the whole burst."""
+        message = burst.latest
+        persona = burst.key[1]
+        history = await self.conversation_histories.load(message.channel.id)
+        messages = context_builder.build(message.channel.id, persona, self.persona_system_prompt(persona, message), history)
+        tags = {"persona": persona, "burst_size": str(len(burst.messages))}
+        try:
+            response = await self.send_reply(
+                message, messages, tags, persona=persona, burst=burst, priority=self.reply_priority(burst.messages)
+            )
+        except RequestShed as e:
+            logger.debug("No reply in channel %s: %s", message.channel.id, e)
+            return
+        self.conversation_histories.append(message.channel.id, "assistant", response, author_id=self.bot.user.id)
+        self.switch_persona(message.guild, persona)
+
+    async def send_reply(self, message, messages, tags, persona=None, burst=None, priority=Priority.TRIGGER):
+        """
+        Generate a persona reply to `message` and post it, streaming it in when STREAM_REPLIES is set.
+        The LLM call waits its turn in the request scheduler at `priority` and raises RequestShed if dropped.
+        A coalesced `burst` is committed just before posting, after which newer messages no longer cancel it.
+        """
+        guild_id = message.guild.id if message.guild else None
+
+        def finalize(text):
+            text = replace_usernames_with_mentions(text, message.guild)
+            text = replace_ping_with_mention(text, message.author)
+            return replace_name_exclamation_with_mention(text, message.author)
+
+        if STREAM_REPLIES:
+            async def stream():
+                if burst is not None:
+                    burst.commit()
+                self.replies_posting += 1
+                try:
+                    return await stream_reply(message.channel, messages, tags, reference=message, transform=finalize)
+                finally:
+                    self.replies_posting -= 1
+            return await scheduler.run(priority, guild_id, stream)
+
+        response = await scheduler.run(
+            priority, guild_id,
+            lambda: get_valid_response(messages, tags, hedge_key=(persona, message.channel.id), persona=persona)
+        )
+        if burst is not None:
+            burst.commit()
+        chunks = split_message(finalize(response), DISCORD_MESSAGE_LIMIT)
+        self.replies_posting += 1
+        try:
+            with stage_timer('discord_send'):
+                for index, chunk in enumerate(chunks):
+                    if index == 0:
+                        await message.reply(chunk)
+                    else:
+                        await message.channel.send(chunk)
+        finally:
+            self.replies_posting -= 1
+        return response
+
+    async def react_to(self, message):
+        """Add an emoji reaction chosen from the message's sentiment (or the LLM when unsure)."""
+        try:
+            emoji = await choose_reaction(message.content)
+        except Exception as e:
+            logger.error("Error choosing a reaction: %s", e, exc_info=True)
+            return
+        if emoji:
+            try:
+                await message.add_reaction(emoji)
+            except discord.HTTPException as e:
+                logger.warning("Could not add reaction %s: %s", emoji, e)
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        """Reply to mentions and trigger words, and sometimes at random; react to messages by chance."""
+        if message.author.bot:
+            return
+        with stage_timer('handle'):
+            if message.guild is not None:
+                note_member_in_name_index(message.guild, message.author)
+            personas = self.match_personas(message.content)
+            guild_id = message.guild.id if message.guild else None
+            reply_probability, reaction_probability = await load_probabilities(guild_id, message.channel.id)
+            if is_bot_mentioned(message, self.bot.user) or personas or random_chance(reply_probability):
+                self.request_reply(message, personas[0] if personas else "sydney")
+            else:
+                self.conversation_histories.append(
+                    message.channel.id, "user", f"{message.author.display_name}: {message.content}", author_id=message.author.id
+                )
+            if random_chance(reaction_probability):
+                task = asyncio.create_task(self.react_to(message))
+                self._reaction_tasks.add(task)
+                task.add_done_callback(self._reaction_tasks.discard)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        update_member_in_name_index(member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        remove_member_from_name_index(member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.display_name != after.display_name or before.name != after.name:
+            update_member_in_name_index(after)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        if before.name != after.name:
+            for guild in after.mutual_guilds:
+                member = guild.get_member(after.id)
+                if member is not None:
+                    update_member_in_name_index(member)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        drop_guild_name_index(guild.id)
+        self.presence.forget_guild(guild.id)
+
+    @tasks.loop(seconds=2)
+    async def update_presence(self):
+        """Apply debounced nickname and presence changes in the background, yielding to replies."""
+        try:
+            await self.presence.drain()
+        except Exception as e:
+            logger.error("Presence update failed: %s", e, exc_info=True)
+
+    @update_presence.before_loop
+    async def before_update_presence(self):
+        await self.bot.wait_until_ready()
+
+    @tasks.loop(hours=BACKUP_INTERVAL_HOURS)
+    async def backup_task(self):
+        """Periodically take an online backup of the preferences database."""
+        try:
+            await backup_database()
+        except Exception as e:
+            logger.error("Database backup failed: %s", e, exc_info=True)
+
+    @backup_task.before_loop
+    async def before_backup_task(self):
+        """Wait until the newest backup is due, so restarts do not rotate out older generations."""
+        age = last_backup_age()
+        if age is not None and age < BACKUP_INTERVAL_HOURS * 3600:
+            await asyncio.sleep(BACKUP_INTERVAL_HOURS * 3600 - age)
+
+    @tasks.loop(minutes=10)
+    async def history_maintenance(self):
+        """Drop idle conversation histories and log how much memory the rest use."""
+        evicted = self.conversation_histories.evict_idle()
+        footprint = self.conversation_histories.footprint()
+        logger.info(
+            "Conversation histories: %d keys, %d entries, %.1f/%.1f MB, %d idle evicted",
+            footprint['keys'], footprint['entries'],
+            footprint['bytes'] / 1024 / 1024, footprint['budget'] / 1024 / 1024, evicted
+        )
+        sizes = context_builder.stats()
+        logger.info(
+            "Prompt tokens p50/p90/p99: %s/%s/%s raw, %s/%s/%s sent; %d summaries",
+            sizes['before']['p50'], sizes['before']['p90'], sizes['before']['p99'],
+            sizes['after']['p50'], sizes['after']['p90'], sizes['after']['p99'], sizes['summaries']
+        )
+
 def setup(bot):
     bot.add_cog(SydneyBotCog(bot))
@@ -1,8 +1,14 @@
 # config.py
 import os
 from dotenv import load_dotenv
+import json
+import time
+import queue
+import atexit
+import random
 import logging
-from logging.handlers import RotatingFileHandler
+import threading
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 # Load environment variables from .env file
 load_dotenv()
@@ -12,29 +18,184 @@ DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY')
 OPENROUTER_API_KEY_EXPENSIVE = os.getenv('OPENROUTER_API_KEY_EXPENSIVE')  # For advanced models
 
+# Upstream LLM client
+OPENPIPE_BASE_URL = os.getenv('OPENPIPE_BASE_URL', 'https://api.openpipe.ai/api/v1')
+# Extra endpoints and keys; every base URL is paired with every key of a tier, and traffic goes to the healthiest pair
+OPENPIPE_FALLBACK_URLS = [url.strip() for url in os.getenv('OPENPIPE_FALLBACK_URLS', '').split(',') if url.strip()]
+OPENROUTER_EXTRA_API_KEYS = [key.strip() for key in os.getenv('OPENROUTER_EXTRA_API_KEYS', '').split(',') if key.strip()]
+OPENROUTER_EXTRA_API_KEYS_EXPENSIVE = [key.strip() for key in os.getenv('OPENROUTER_EXTRA_API_KEYS_EXPENSIVE', '').split(',') if key.strip()]
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))  # Consecutive failures that take an endpoint out of rotation
+CIRCUIT_ERROR_RATE = float(os.getenv('CIRCUIT_ERROR_RATE', '0.5'))  # Rolling error rate that does the same
+CIRCUIT_COOLDOWN = float(os.getenv('CIRCUIT_COOLDOWN', '15'))  # Seconds before a failed endpoint is probed again
+CIRCUIT_MAX_COOLDOWN = float(os.getenv('CIRCUIT_MAX_COOLDOWN', '300'))  # Cap for the cooldown, which doubles per failed probe
+LLM_RETRY_ATTEMPTS = int(os.getenv('LLM_RETRY_ATTEMPTS', '3'))  # Tries per completion call across endpoints
+LLM_RETRY_BACKOFF = float(os.getenv('LLM_RETRY_BACKOFF', '0.5'))  # Base seconds of the jittered exponential backoff between tries
+LLM_CLIENT_MODE = os.getenv('LLM_CLIENT_MODE', 'async').lower()  # 'async' (pooled aiohttp) or 'sync' (openpipe SDK in a thread)
+LLM_REQUEST_TIMEOUT = float(os.getenv('LLM_REQUEST_TIMEOUT', '60'))  # Seconds per completion call
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '32'))  # Completion calls in flight across all models
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'true').lower() == 'true'  # Race the expensive model against refusal-prone or slow calls
+HEDGE_RISK_THRESHOLD = float(os.getenv('HEDGE_RISK_THRESHOLD', '0.3'))  # Predicted refusal rate that triggers an immediate hedge
+HEDGE_LATENCY_BUDGET = float(os.getenv('HEDGE_LATENCY_BUDGET', '8'))  # Seconds to wait for the regular model before hedging
+REACTION_LOCAL_CONFIDENCE = float(os.getenv('REACTION_LOCAL_CONFIDENCE', '0.5'))  # Sentiment confidence needed to skip the LLM for a reaction
+# Opt-in completion cache for repeated short prompts, enabled per persona, e.g. "sydney,eos"
+RESPONSE_CACHE_PERSONAS = {name.strip() for name in os.getenv('RESPONSE_CACHE_PERSONAS', '').split(',') if name.strip()}
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', '300'))
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '2000'))
+RESPONSE_CACHE_WINDOW = int(os.getenv('RESPONSE_CACHE_WINDOW', '4'))  # Trailing non-system messages that make up the key
+REACTION_CACHE_ENABLED = os.getenv('REACTION_CACHE_ENABLED', 'false').lower() == 'true'
+REACTION_CACHE_TTL = float(os.getenv('REACTION_CACHE_TTL', '3600'))
+REACTION_CACHE_SIZE = int(os.getenv('REACTION_CACHE_SIZE', '5000'))
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', 'false').lower() == 'true'  # Post persona replies progressively as they stream
+HISTORY_MEMORY_BUDGET_MB = float(os.getenv('HISTORY_MEMORY_BUDGET_MB', '64'))  # Memory for conversation histories across all channels
+HISTORY_IDLE_HOURS = float(os.getenv('HISTORY_IDLE_HOURS', '24'))  # Forget histories of channels idle for this long
+HISTORY_PERSIST = os.getenv('HISTORY_PERSIST', 'true').lower() == 'true'  # Log conversations under data/conversations to survive restarts
+REPLY_DEBOUNCE = float(os.getenv('REPLY_DEBOUNCE', '1.0'))  # Quiet seconds before a channel's triggering messages are answered together
+REPLY_MAX_DEBOUNCE = float(os.getenv('REPLY_MAX_DEBOUNCE', '4.0'))  # Longest a triggering message waits for the burst to end
+LLM_RATE_LIMIT = float(os.getenv('LLM_RATE_LIMIT', '5'))  # Upstream calls per second, retries and hedges included, admitted by the scheduler
+LLM_RATE_BURST = float(os.getenv('LLM_RATE_BURST', '10'))  # Calls that may be sent at once after a quiet period
+SCHEDULER_MAX_QUEUE = int(os.getenv('SCHEDULER_MAX_QUEUE', '200'))  # Queued requests before random replies and reactions are shed
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '3000'))  # Prompt tokens per reply; older history is summarized
+NICKNAME_DEBOUNCE = float(os.getenv('NICKNAME_DEBOUNCE', '30'))  # Seconds a persona must stay active in a guild before the nickname follows
+NICKNAME_EDIT_RATE = float(os.getenv('NICKNAME_EDIT_RATE', '0.5'))  # Nickname edits per second across all guilds
+PRESENCE_MIN_INTERVAL = float(os.getenv('PRESENCE_MIN_INTERVAL', '60'))  # Shortest time between presence changes
+METRICS_PORT = int(os.getenv('METRICS_PORT')) if os.getenv('METRICS_PORT') else None  # Serve Prometheus metrics when set
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Optional per-model caps, e.g. "openpipe:CSRv2=4,openpipe:Sydney-Court=16"
+LLM_MODEL_CONCURRENCY = {
+    model.strip(): int(limit)
+    for model, _, limit in (item.rpartition('=') for item in os.getenv('LLM_MODEL_CONCURRENCY', '').split(',') if item.strip())
+}
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()  # Level written to logs/sydneybot.log; the console shows INFO and up
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()  # 'text' or 'json' (one JSON object per line) for the log file
+LOG_DEBUG_RATE = float(os.getenv('LOG_DEBUG_RATE', '20'))  # Debug lines per second allowed per message template (0 = unlimited)
+# Optional share of debug lines kept per module logger, e.g. "helpers=0.1,openapi=0.5"
+LOG_SAMPLING = {
+    name.strip(): float(rate)
+    for name, _, rate in (item.rpartition('=') for item in os.getenv('LOG_SAMPLING', '').split(',') if item.strip())
+}
+# Optional per-persona prompt token budgets, e.g. "sydney=4000,eos=2000"
+CONTEXT_PERSONA_BUDGETS = {
+    persona.strip(): int(budget)
+    for persona, _, budget in (item.rpartition('=') for item in os.getenv('CONTEXT_PERSONA_BUDGETS', '').split(',') if item.strip())
+}
+
 if not DISCORD_TOKEN:
     raise EnvironmentError("Missing DISCORD_TOKEN in environment variables.")
 if not OPENROUTER_API_KEY:
     raise EnvironmentError("Missing OPENROUTER_API_KEY in environment variables.")
 if not OPENROUTER_API_KEY_EXPENSIVE:
     raise EnvironmentError("Missing OPENROUTER_API_KEY_EXPENSIVE in environment variables.")
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    raise ValueError(f"Invalid LOG_LEVEL {LOG_LEVEL!r}; use DEBUG, INFO, WARNING, ERROR or CRITICAL.")
 
 # Logging Configuration
 if not os.path.exists('logs'):
     os.makedirs('logs')
 
+class TextFormatter(logging.Formatter):
+    """The plain text log format, noting how many similar debug lines the rate limit dropped."""
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f"{text} [{suppressed} similar line(s) suppressed]" if suppressed else text
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class DebugSampler(logging.Filter):
+    """
+    Thin out high-volume debug lines before they are queued.
+
+    Each module logger keeps its LOG_SAMPLING share of debug records, and each
+    message template is limited to LOG_DEBUG_RATE lines per second. The next
+    line let through for a template carries how many were dropped. Records at
+    INFO and above always pass.
+    """
+
+    def __init__(self, sampling, rate):
+        super().__init__()
+        self.sampling = {f"sydneybot.{name}": share for name, share in sampling.items()}
+        self.rate = rate
+        self._windows = {}  # (logger, template) -> [window start, lines in window, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        share = self.sampling.get(record.name)
+        if share is not None and random.random() >= share:
+            return False
+        if not self.rate:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= 1.0:
+                suppressed = window[2] if window else 0
+                if len(self._windows) > 10000:
+                    self._windows.clear()  # Templates are normally fixed strings; this only trips on f-string messages
+                self._windows[key] = [now, 1, 0]
+                record.suppressed = suppressed
+                return True
+            if window[1] >= self.rate:
+                window[2] += 1
+                return False
+            window[1] += 1
+            record.suppressed = 0
+            return True
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Queue records untouched so message formatting happens on the writer thread.
+
+    The stock QueueHandler formats each record in the caller's thread to make
+    it picklable; this queue never leaves the process, so that is not needed.
+    """
+
+    def prepare(self, record):
+        return record
+
+def get_logger(name):
+    """Child of the 'sydneybot' logger for a module, so sampling and filtering can target it by name."""
+    return logging.getLogger('sydneybot').getChild(name)
+
 logger = logging.getLogger('sydneybot')
-logger.setLevel(logging.DEBUG)  # Set to DEBUG for detailed logs
+logger.setLevel(min(logging.getLevelName(LOG_LEVEL), logging.INFO))  # Debug records are not even created unless LOG_LEVEL asks for them
 
-# File Handler with Rotation
+# File Handler with Rotation; rotation and disk writes happen on the listener thread
 file_handler = RotatingFileHandler('logs/sydneybot.log', maxBytes=5*1024*1024, backupCount=5, encoding='utf-8')
-file_formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s - %(message)s')
-file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
+file_handler.setLevel(LOG_LEVEL)
+if LOG_FORMAT == 'json':
+    file_handler.setFormatter(JsonFormatter())
+else:
+    file_handler.setFormatter(TextFormatter('%(asctime)s %(levelname)s %(name)s - %(message)s'))
 
 # Console Handler
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 console_formatter = logging.Formatter('[%(levelname)s] %(message)s')
 console_handler.setFormatter(console_formatter)
-logger.addHandler(console_handler)
\ No newline at end of file
+
+# Callers only put records on a queue; a background thread formats and writes them
+log_queue = queue.SimpleQueue()
+queue_handler = DeferredQueueHandler(log_queue)
+queue_handler.addFilter(DebugSampler(LOG_SAMPLING, LOG_DEBUG_RATE))
+logger.addHandler(queue_handler)
+log_listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)  # Drain the queue before logging shuts down
\ No newline at end of file
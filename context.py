@@ -0,0 +1,183 @@
+# context.py
+import math
+import time
+import asyncio
+from collections import deque
+from functools import lru_cache
+from cache import LRUCache
+from config import CONTEXT_TOKEN_BUDGET, CONTEXT_PERSONA_BUDGETS, get_logger
+from helpers import is_refusal
+from openapi import create_completion, MODEL_REGULAR
+from scheduler import scheduler, Priority, RequestShed
+from metrics import instrument, count
+
+logger = get_logger('context')
+
+try:
+    import tiktoken
+except ImportError:  # Optional; the estimator below is used without it
+    tiktoken = None
+
+MESSAGE_OVERHEAD_TOKENS = 4  # Role and separators added per chat message
+SUMMARY_MAX_WORDS = 150
+SUMMARY_INPUT_TOKENS = 300  # Per-message cap on what is sent to the summarizer
+SUMMARY_REFRESH_MESSAGES = 4  # Dropped messages not yet in the summary that trigger a refresh
+SUMMARY_CACHE_SIZE = 5000
+SUMMARY_RETRY_DELAY = 60  # Seconds before retrying a conversation whose summary failed
+PROMPT_SIZE_SAMPLES = 1000  # Recent prompts kept for the size percentiles
+
+_encoding = tiktoken.get_encoding('cl100k_base') if tiktoken is not None else None
+
+@lru_cache(maxsize=16384)
+def estimate_tokens(text):
+    """
+    Token count of `text`: exact with tiktoken installed, otherwise estimated
+    at about four ASCII characters per token and one token per other character
+    (emoji, CJK), which tracks cl100k within ~10% on chat text.
+    """
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+def message_tokens(message):
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+def _truncate_to_tokens(text, tokens):
+    """Keep the end of `text` (the most recent part of a long paste) within about `tokens` tokens."""
+    while text and estimate_tokens(text) > tokens:
+        keep = min(len(text) - 1, int(len(text) * tokens / estimate_tokens(text)))
+        text = text[len(text) - keep:] if keep > 0 else ''
+    return text
+
+def _fingerprint(message):
+    return hash((message["role"], message["content"]))
+
+def _percentiles(values):
+    if not values:
+        return {'p50': 0, 'p90': 0, 'p99': 0}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99)}
+
+class ContextBuilder:
+    """
+    Fits a conversation into a persona's token budget.
+
+    The newest messages that fit are sent verbatim; older ones are replaced
+    by a rolling summary of the conversation. Summaries are refreshed in the
+    background once enough dropped messages are missing from them, so the
+    reply path never waits for one; until then the previous summary is used.
+    """
+
+    def __init__(self, default_budget=CONTEXT_TOKEN_BUDGET, persona_budgets=CONTEXT_PERSONA_BUDGETS):
+        self.default_budget = default_budget
+        self.persona_budgets = persona_budgets
+        self._summaries = LRUCache(SUMMARY_CACHE_SIZE)  # key -> (summary, fingerprint of its last message)
+        self._refreshing = {}  # key -> background summary task
+        self._failed = LRUCache(SUMMARY_CACHE_SIZE)  # key -> time of the last failed summary
+        self._raw_sizes = deque(maxlen=PROMPT_SIZE_SAMPLES)
+        self._built_sizes = deque(maxlen=PROMPT_SIZE_SAMPLES)
+        self.summaries_made = 0
+
+    def budget_for(self, persona):
+        return self.persona_budgets.get(persona, self.default_budget)
+
+    @instrument('context_build')
+    def build(self, key, persona, system_prompt, history):
+        """Return the messages to send: system prompt, summary of older messages, and the newest messages that fit."""
+        system_tokens = estimate_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS
+        history_tokens = [message_tokens(message) for message in history]
+        self._raw_sizes.append(system_tokens + sum(history_tokens))
+
+        available = self.budget_for(persona) - system_tokens
+        summary = None
+        summary_tokens = 0
+        if sum(history_tokens) > available:
+            # Something has to go; make room for the summary that stands in for it
+            summary = self._summaries.get(key)
+            summary_tokens = estimate_tokens(summary[0]) + MESSAGE_OVERHEAD_TOKENS if summary else 0
+            available -= summary_tokens
+
+        cut = len(history)
+        used = 0
+        while cut > 0 and used + history_tokens[cut - 1] <= available:
+            cut -= 1
+            used += history_tokens[cut]
+        kept = list(history[cut:])
+        if not kept and history:
+            # The latest message alone is over budget: keep its tail
+            latest = history[-1]
+            kept = [{"role": latest["role"], "content": _truncate_to_tokens(latest["content"], max(available - MESSAGE_OVERHEAD_TOKENS, 1))}]
+            used = message_tokens(kept[0])
+            cut = len(history) - 1
+
+        messages = [{"role": "system", "content": system_prompt}]
+        if cut > 0:
+            self._maybe_refresh(key, summary, history[:cut])
+            if summary:
+                messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary[0]}"})
+        messages.extend(kept)
+        self._built_sizes.append(system_tokens + summary_tokens + used)
+        return messages
+
+    def stats(self):
+        """Prompt-size percentiles in tokens, before and after fitting to the budget."""
+        return {
+            'before': _percentiles(self._raw_sizes),
+            'after': _percentiles(self._built_sizes),
+            'summaries': self.summaries_made,
+        }
+
+    def _maybe_refresh(self, key, summary, dropped):
+        if key in self._refreshing:
+            return
+        failed_at = self._failed.get(key)
+        if failed_at is not None and time.monotonic() - failed_at < SUMMARY_RETRY_DELAY:
+            return
+        unsummarized = dropped
+        if summary is not None:
+            for index in range(len(dropped) - 1, -1, -1):
+                if _fingerprint(dropped[index]) == summary[1]:
+                    unsummarized = dropped[index + 1:]
+                    break
+        if not unsummarized or (summary is not None and len(unsummarized) < SUMMARY_REFRESH_MESSAGES):
+            return
+        task = asyncio.create_task(self._refresh(key, summary[0] if summary else None, list(unsummarized)))
+        self._refreshing[key] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(key, None))
+
+    async def _refresh(self, key, previous, messages):
+        transcript = "\n".join(
+            f"{message['role']}: {_truncate_to_tokens(message['content'], SUMMARY_INPUT_TOKENS)}" for message in messages
+        )
+        if previous:
+            transcript = f"Summary so far: {previous}\n\nNewer messages:\n{transcript}"
+        prompt = [
+            {"role": "system", "content": (
+                f"Summarize this Discord conversation in under {SUMMARY_MAX_WORDS} words. "
+                "Keep names, facts, promises and open questions; drop greetings and filler."
+            )},
+            {"role": "user", "content": transcript},
+        ]
+        try:
+            summary = await scheduler.run(
+                Priority.BACKGROUND, None,
+                lambda: create_completion(MODEL_REGULAR, prompt, 0.3, tags={"purpose": "summary"})
+            )
+        except RequestShed:
+            return
+        except Exception as e:
+            logger.warning("Could not summarize conversation %s: %s", key, e)
+            self._failed.set(key, time.monotonic())
+            return
+        summary = (summary or '').strip()
+        if summary and not is_refusal(summary):
+            self._summaries.set(key, (summary, _fingerprint(messages[-1])))
+            self._failed.pop(key)
+            self.summaries_made += 1
+            count('summary_refreshed')
+        else:
+            self._failed.set(key, time.monotonic())
+
+context_builder = ContextBuilder()
@@ -1,95 +1,312 @@
 # database.py
-import sqlite3
-import threading
-import shutil
+import asyncio
 import os
-from config import logger
+import sqlite3
+import time
+from cache import LRUCache
+from config import get_logger
+from metrics import instrument
+from worker import BatchedWorker
+
+logger = get_logger('database')
 
-db_lock = threading.Lock()
 DATABASE_FILE = 'user_preferences.db'
+FLUSH_INTERVAL = 0.05  # Seconds a write may sit uncommitted before the batch is flushed
+MAX_BATCH_SIZE = 256  # Pending writes that force an early commit
+PREFERENCE_CACHE_SIZE = 50000
+PROBABILITY_CACHE_SIZE = 20000
+DEFAULT_REPLY_PROBABILITY = 0.1
+DEFAULT_REACTION_PROBABILITY = 0.2
+BACKUP_INTERVAL_HOURS = 6
+BACKUP_GENERATIONS = 5  # Rotated copies kept: .bak, .bak.1, ... .bak.4
+BACKUP_PAGES_PER_STEP = 100
+BACKUP_STEP_SLEEP = 0.01  # Seconds between backup steps, letting writers through
+
+_MISSING = object()
+
+class DatabaseEngine(BatchedWorker):
+    """
+    Long-lived SQLite connection in WAL mode, owned by a dedicated worker thread.
+
+    Jobs run in submission order on the worker, so reads always observe earlier
+    writes. Writes execute immediately but are committed in batches every
+    `flush_interval` seconds, once `max_batch_size` writes are pending, or on close.
+    Write jobs that update a cache register an undo with `on_rollback`, which
+    runs if their batch fails to commit.
+    """
+
+    def __init__(self, path, flush_interval=FLUSH_INTERVAL, max_batch_size=MAX_BATCH_SIZE):
+        super().__init__('sydneybot-db', flush_interval)
+        self.path = path
+        self.max_batch_size = max_batch_size
+        self._conn = None
+        self._pending_writes = 0
+        self._rollback_hooks = []
+
+    def submit(self, fn, write=False):
+        """Queue `fn(conn)` on the worker thread and return a concurrent Future."""
+        return super().submit(fn, write=write)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        """Execute a write; resolves once executed, before the batch is committed."""
+        await self.run(lambda conn: conn.execute(sql, params).rowcount, write=True)
+
+    async def flush(self):
+        """Commit any pending writes now."""
+        await self.run(self._commit)
+
+    def on_rollback(self, fn):
+        """From a write job: call `fn()` on the worker thread if the current batch is rolled back."""
+        self._rollback_hooks.append(fn)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, isolation_level=None)  # Transactions are managed explicitly
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=5000')
+        self._conn = conn
+
+    def _execute(self, fn, options):
+        write = options.get('write', False)
+        try:
+            if write and not self._conn.in_transaction:
+                self._conn.execute('BEGIN')
+            return fn(self._conn)
+        finally:
+            if write:
+                self._pending_writes += 1
+                self._mark_dirty()
+
+    def _flush_due(self):
+        return self._pending_writes >= self.max_batch_size or super()._flush_due()
+
+    def _flush(self):
+        self._commit(self._conn)
+
+    def _commit(self, conn):
+        if conn.in_transaction:
+            try:
+                conn.execute('COMMIT')
+            except sqlite3.Error as e:
+                logger.error("Failed to commit %d batched write(s): %s", self._pending_writes, e, exc_info=True)
+                conn.execute('ROLLBACK')
+                for hook in self._rollback_hooks:
+                    hook()
+        self._rollback_hooks.clear()
+        self._pending_writes = 0
+        self._flush_deadline = None
+
+    def _close(self):
+        self._conn.close()
+        self._conn = None
+        logger.info("Database connection closed.")
+
+engine = DatabaseEngine(DATABASE_FILE)
+
+def _on_preference_evicted(user_id, prefix):
+    global _preferences_complete
+    _preferences_complete = False
+
+def _on_probabilities_evicted(key, probabilities):
+    global _probabilities_complete
+    _probabilities_complete = False
+
+def _forget_preference(user_id):
+    """Drop a cached preference whose write was rolled back; the next load reads the database."""
+    _on_preference_evicted(user_id, preference_cache.pop(user_id))
+
+def _forget_probabilities(key):
+    _on_probabilities_evicted(key, probability_cache.pop(key))
+
+# Read-through caches in front of the hot lookups; saves update them in place
+preference_cache = LRUCache(PREFERENCE_CACHE_SIZE, on_evict=_on_preference_evicted)
+probability_cache = LRUCache(PROBABILITY_CACHE_SIZE, on_evict=_on_probabilities_evicted)
+_preferences_complete = False
+_probabilities_complete = False
+
+def _create_schema(conn):
+    # Create user preferences table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_preferences (
+            user_id INTEGER PRIMARY KEY,
+            message_prefix TEXT
+        )
+    ''')
+    # Create probabilities table
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS probabilities (
+            guild_id TEXT,
+            channel_id TEXT,
+            reply_probability REAL DEFAULT 0.1,
+            reaction_probability REAL DEFAULT 0.2,
+            PRIMARY KEY (guild_id, channel_id)
+        )
+    ''')
 
 def init_database():
-    with db_lock:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        # Create user preferences table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_preferences (
-                user_id INTEGER PRIMARY KEY,
-                message_prefix TEXT
-            )
-        ''')
-        # Create probabilities table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS probabilities (
-                guild_id TEXT,
-                channel_id TEXT,
-                reply_probability REAL DEFAULT 0.1,
-                reaction_probability REAL DEFAULT 0.2,
-                PRIMARY KEY (guild_id, channel_id)
-            )
-        ''')
-        conn.commit()
-        conn.close()
-        logger.info("Database initialized.")
-
-def load_user_preference(user_id):
+    """Start the database engine and make sure the schema exists."""
+    engine.start()
+    engine.run_sync(_create_schema, write=True)
+    engine.run_sync(engine._commit)
+    logger.info("Database initialized.")
+
+def close_database():
+    """Flush pending writes and stop the database engine."""
+    engine.close()
+
+@instrument('db_lookup')
+async def load_user_preference(user_id):
     """Load user preferences."""
-    with db_lock:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT message_prefix FROM user_preferences WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
-        conn.close()
-        return result[0] if result else None
-
-def save_user_preference(user_id, message_prefix):
+    prefix = preference_cache.get(user_id, _MISSING)
+    if prefix is not _MISSING:
+        return prefix
+    if _preferences_complete:
+        return None
+
+    def load(conn):
+        result = conn.execute('SELECT message_prefix FROM user_preferences WHERE user_id = ?', (user_id,)).fetchone()
+        prefix = result[0] if result else None
+        preference_cache.set(user_id, prefix)
+        return prefix
+
+    return await engine.run(load)
+
+async def save_user_preference(user_id, message_prefix):
     """Save user preferences."""
-    with db_lock:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('REPLACE INTO user_preferences (user_id, message_prefix) VALUES (?, ?)', (user_id, message_prefix))
-        conn.commit()
-        conn.close()
-
-def load_probabilities(guild_id, channel_id):
+    def save(conn):
+        conn.execute('REPLACE INTO user_preferences (user_id, message_prefix) VALUES (?, ?)', (user_id, message_prefix))
+        preference_cache.set(user_id, message_prefix)
+        engine.on_rollback(lambda: _forget_preference(user_id))
+
+    await engine.run(save, write=True)
+
+def _select_probabilities(conn, guild_id, channel_id):
+    result = conn.execute('''
+        SELECT reply_probability, reaction_probability
+        FROM probabilities
+        WHERE guild_id = ? AND channel_id = ?
+    ''', (guild_id, channel_id)).fetchone()
+    if result:
+        return result
+    else:
+        return DEFAULT_REPLY_PROBABILITY, DEFAULT_REACTION_PROBABILITY
+
+@instrument('db_lookup')
+async def load_probabilities(guild_id, channel_id):
     """Load reply and reaction probabilities."""
-    with db_lock:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT reply_probability, reaction_probability 
-            FROM probabilities 
-            WHERE guild_id = ? AND channel_id = ?
-        ''', (guild_id, channel_id))
-        result = cursor.fetchone()
-        conn.close()
-        if result:
-            return result
-        else:
-            return 0.1, 0.2  # Default probabilities
-
-def save_probabilities(guild_id, channel_id, reply_probability=None, reaction_probability=None):
+    # The columns are TEXT; callers pass Discord IDs as ints, so keys are always strings
+    guild_id, channel_id = str(guild_id), str(channel_id)
+    key = (guild_id, channel_id)
+    probabilities = probability_cache.get(key)
+    if probabilities is not None:
+        return probabilities
+    if _probabilities_complete:
+        return DEFAULT_REPLY_PROBABILITY, DEFAULT_REACTION_PROBABILITY
+
+    def load(conn):
+        probabilities = _select_probabilities(conn, guild_id, channel_id)
+        probability_cache.set(key, probabilities)
+        return probabilities
+
+    return await engine.run(load)
+
+async def save_probabilities(guild_id, channel_id, reply_probability=None, reaction_probability=None):
     """Save reply and reaction probabilities."""
-    current_reply_prob, current_reaction_prob = load_probabilities(guild_id, channel_id)
-    reply_probability = reply_probability if reply_probability is not None else current_reply_prob
-    reaction_probability = reaction_probability if reaction_probability is not None else current_reaction_prob
-    with db_lock:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('''
+    guild_id, channel_id = str(guild_id), str(channel_id)
+    params = {
+        'guild_id': guild_id,
+        'channel_id': channel_id,
+        'reply': reply_probability,
+        'reaction': reaction_probability,
+        'default_reply': DEFAULT_REPLY_PROBABILITY,
+        'default_reaction': DEFAULT_REACTION_PROBABILITY,
+    }
+
+    def save(conn):
+        # A single upsert; a None argument keeps the stored (or default) value
+        conn.execute('''
             INSERT INTO probabilities (guild_id, channel_id, reply_probability, reaction_probability)
-            VALUES (?, ?, ?, ?)
+            VALUES (:guild_id, :channel_id, COALESCE(:reply, :default_reply), COALESCE(:reaction, :default_reaction))
             ON CONFLICT(guild_id, channel_id) DO UPDATE SET
-                reply_probability = excluded.reply_probability,
-                reaction_probability = excluded.reaction_probability
-        ''', (guild_id, channel_id, reply_probability, reaction_probability))
-        conn.commit()
-        conn.close()
-
-def backup_database():
-    """Create a backup of the database file."""
-    with db_lock:
-        backup_file = f"{DATABASE_FILE}.bak"
-        shutil.copy(DATABASE_FILE, backup_file)
-    logger.info("Database backup created.")
\ No newline at end of file
+                reply_probability = COALESCE(:reply, reply_probability),
+                reaction_probability = COALESCE(:reaction, reaction_probability)
+        ''', params)
+        probability_cache.set((guild_id, channel_id), _select_probabilities(conn, guild_id, channel_id))
+        engine.on_rollback(lambda: _forget_probabilities((guild_id, channel_id)))
+
+    await engine.run(save, write=True)
+
+async def warm_cache():
+    """Preload the preference and probability caches so lookups skip the database."""
+    global _preferences_complete, _probabilities_complete
+
+    def warm(conn):
+        preferences = conn.execute(
+            'SELECT user_id, message_prefix FROM user_preferences LIMIT ?', (PREFERENCE_CACHE_SIZE + 1,)
+        ).fetchall()
+        probabilities = conn.execute('''
+            SELECT guild_id, channel_id, reply_probability, reaction_probability
+            FROM probabilities
+            LIMIT ?
+        ''', (PROBABILITY_CACHE_SIZE + 1,)).fetchall()
+        for user_id, message_prefix in preferences[:PREFERENCE_CACHE_SIZE]:
+            preference_cache.set(user_id, message_prefix)
+        for guild_id, channel_id, reply_prob, reaction_prob in probabilities[:PROBABILITY_CACHE_SIZE]:
+            probability_cache.set((str(guild_id), str(channel_id)), (reply_prob, reaction_prob))
+        return len(preferences), len(probabilities)
+
+    preference_count, probability_count = await engine.run(warm)
+    # When every row fits, a cache miss means "not stored" until something is evicted
+    _preferences_complete = preference_count <= PREFERENCE_CACHE_SIZE and preference_cache.evictions == 0
+    _probabilities_complete = probability_count <= PROBABILITY_CACHE_SIZE and probability_cache.evictions == 0
+    logger.info("Database cache warmed with %d preference(s) and %d probability row(s).", len(preference_cache), len(probability_cache))
+
+def _backup_file(generation):
+    """Path of a backup generation; 0 is the newest."""
+    return f"{DATABASE_FILE}.bak" if generation == 0 else f"{DATABASE_FILE}.bak.{generation}"
+
+def last_backup_age():
+    """Seconds since the newest backup was written, or None if there is none."""
+    try:
+        return time.time() - os.path.getmtime(_backup_file(0))
+    except OSError:
+        return None
+
+def _run_online_backup(pages_per_step, step_sleep, generations):
+    started = time.perf_counter()
+    temp_file = f"{DATABASE_FILE}.bak.tmp"
+    source = sqlite3.connect(DATABASE_FILE)
+    target = sqlite3.connect(temp_file)
+    try:
+        # Copies a few pages per step and sleeps in between so writers are never locked out for long
+        source.backup(target, pages=pages_per_step, sleep=step_sleep)
+    finally:
+        target.close()
+        source.close()
+
+    for generation in range(generations - 1, 0, -1):
+        if os.path.exists(_backup_file(generation - 1)):
+            os.replace(_backup_file(generation - 1), _backup_file(generation))
+    os.replace(temp_file, _backup_file(0))
+
+    return {
+        'file': _backup_file(0),
+        'size_bytes': os.path.getsize(_backup_file(0)),
+        'duration_seconds': time.perf_counter() - started,
+    }
+
+async def backup_database(generations=BACKUP_GENERATIONS, pages_per_step=BACKUP_PAGES_PER_STEP, step_sleep=BACKUP_STEP_SLEEP):
+    """Create an online backup of the database and rotate older generations."""
+    await engine.flush()
+    report = await asyncio.to_thread(_run_online_backup, pages_per_step, step_sleep, generations)
+    logger.info(
+        "Database backup created at %s (%d bytes in %.2fs, keeping %d generation(s)).",
+        report['file'], report['size_bytes'], report['duration_seconds'], generations
+    )
+    return report
@@ -1,15 +1,89 @@
 # helpers.py
 import re
 import random
-import datetime
-from pytz import timezone
-from config import logger
+from collections import namedtuple
+from functools import lru_cache
+from config import get_logger
+from prompts import compile_template
+from metrics import instrument
 
+logger = get_logger('helpers')
+
+TriggerMatch = namedtuple('TriggerMatch', ['persona', 'word', 'start', 'end'])  # Offsets into content.lower()
+
+def _trie_regex(words):
+    """Build a regex that factors out shared prefixes, so each position is tried against one branch."""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # Greedy optional suffixes try the longest word first, like a longest-first alternation
+        return '(?:' + body + ')?' if '' in node else body
+
+    return build(trie)
+
+@lru_cache(maxsize=256)
+def _compile_trigger_pattern(trigger_words):
+    # Matched against content.lower() rather than with re.IGNORECASE, which also
+    # equates characters such as ſ with s and İ with i that lower() leaves distinct
+    words = {word.lower() for word in trigger_words}
+    return re.compile(r'\b(' + _trie_regex(words) + r')\b')
+
+@instrument('trigger_match')
 def contains_trigger_word(content, trigger_words):
     """Check if the content contains any of the trigger words."""
-    content_lower = content.lower()
-    pattern = r'\b(' + '|'.join(re.escape(word.lower()) for word in trigger_words) + r')\b'
-    return re.search(pattern, content_lower) is not None
+    if not trigger_words:
+        return False
+    return _compile_trigger_pattern(tuple(trigger_words)).search(content.lower()) is not None
+
+class TriggerMatcher:
+    """
+    Matches the trigger words of every persona in a single pass over a message.
+
+    The combined pattern is compiled once; use `is_stale` to detect when the
+    personas' trigger words have changed and the matcher must be rebuilt.
+    Like the original per-persona check, it searches the lowercased message.
+    """
+
+    def __init__(self, personas):
+        self.signature = self._signature(personas)
+        self._word_personas = {}
+        for persona_name, persona in personas.items():
+            for word in persona.get('trigger_words', []):
+                self._word_personas.setdefault(word.lower(), []).append(persona_name)
+        self._pattern = _compile_trigger_pattern(tuple(self._word_personas)) if self._word_personas else None
+
+    @staticmethod
+    def _signature(personas):
+        return tuple((name, tuple(persona.get('trigger_words', []))) for name, persona in personas.items())
+
+    def is_stale(self, personas):
+        """Return True if `personas` no longer match the words this matcher was built from."""
+        return self._signature(personas) != self.signature
+
+    @instrument('trigger_match')
+    def find(self, content):
+        """Return a TriggerMatch for every trigger word occurrence in `content`."""
+        if self._pattern is None:
+            return []
+        matches = []
+        for match in self._pattern.finditer(content.lower()):
+            word = match.group(1)
+            for persona_name in self._word_personas[word]:
+                matches.append(TriggerMatch(persona_name, word, match.start(), match.end()))
+        return matches
+
+    def matched_personas(self, content):
+        """Return the personas triggered by `content`, in order of first appearance."""
+        return list(dict.fromkeys(match.persona for match in self.find(content)))
 
 def is_bot_mentioned(message, bot_user):
     """Check if the bot is mentioned in the message."""
@@ -19,37 +93,212 @@ def random_chance(probability):
     """Return True with the given probability."""
     return random.random() < probability
 
+_NAME_FOLD_FIXES = {0x130: 'i', 0x131: 'i'}  # re.IGNORECASE equates İ and ı with i; casefold() does not
+_NAME_KEY_LENGTH = 3
+
+def _fold_name(text):
+    """Fold case so that anything a re.IGNORECASE name pattern matches is also a plain substring match."""
+    return text.translate(_NAME_FOLD_FIXES).casefold()
+
+class GuildNameIndex:
+    """
+    Index of a guild's member names for replace_usernames_with_mentions.
+
+    Folded names are bucketed by their first few characters, so one scan over a
+    reply finds the handful of names it can contain. Only those names are then
+    substituted, in the same order and with the same patterns as a sweep over
+    every member, which keeps the output identical. The index is kept current
+    with add_member/update_member/remove_member instead of being rebuilt.
+    """
+
+    def __init__(self, members=()):
+        self._next_order = 0
+        self._members = {}  # member id -> (order, names)
+        self._claims = {}  # name -> {(member order, slot): mention}
+        self._folded = {}  # folded name -> set of names
+        self._buckets = {}  # folded prefix -> {folded length: count}
+        self._angle_names = set()  # Names that could straddle an inserted <@id> mention
+        self._patterns = {}
+        for member in members:
+            self.add_member(member)
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, member_id):
+        return member_id in self._members
+
+    def add_member(self, member):
+        if member.id in self._members:
+            self.update_member(member)
+            return
+        self._claim(member, self._next_order)
+        self._next_order += 1
+
+    def update_member(self, member):
+        """Re-index a member's names, keeping its position in member order."""
+        entry = self._members.get(member.id)
+        if entry is None:
+            self.add_member(member)
+            return
+        self.remove_member(member.id)
+        self._claim(member, entry[0])
+
+    def remove_member(self, member_id):
+        entry = self._members.pop(member_id, None)
+        if entry is None:
+            return
+        order, names = entry
+        for slot, name in enumerate(names):
+            claims = self._claims.get(name)
+            if claims is None:
+                continue
+            claims.pop((order, slot), None)
+            if not claims:
+                self._unregister(name)
+
+    def _claim(self, member, order):
+        names = (member.display_name, member.name)
+        self._members[member.id] = (order, names)
+        for slot, name in enumerate(names):
+            if not name.strip():
+                continue
+            claims = self._claims.get(name)
+            if claims is None:
+                claims = self._claims[name] = {}
+                self._register(name)
+            claims[(order, slot)] = member.mention
+
+    def _register(self, name):
+        folded = _fold_name(name)
+        names = self._folded.setdefault(folded, set())
+        if not names:
+            lengths = self._buckets.setdefault(folded[:_NAME_KEY_LENGTH], {})
+            lengths[len(folded)] = lengths.get(len(folded), 0) + 1
+        names.add(name)
+        if '<' in name or '>' in name:
+            self._angle_names.add(name)
+
+    def _unregister(self, name):
+        del self._claims[name]
+        self._patterns.pop(name, None)
+        self._angle_names.discard(name)
+        folded = _fold_name(name)
+        names = self._folded[folded]
+        names.discard(name)
+        if not names:
+            del self._folded[folded]
+            key = folded[:_NAME_KEY_LENGTH]
+            lengths = self._buckets[key]
+            lengths[len(folded)] -= 1
+            if not lengths[len(folded)]:
+                del lengths[len(folded)]
+            if not lengths:
+                del self._buckets[key]
+
+    def _owner(self, name):
+        """(member order, slot) of the first member claiming `name`, and that member's mention."""
+        claims = self._claims[name]
+        first = min(claims)
+        return first, claims[first]
+
+    def _find_names(self, text, found):
+        folded = _fold_name(text)
+        for start in range(len(folded)):
+            for key_length in range(1, _NAME_KEY_LENGTH + 1):
+                lengths = self._buckets.get(folded[start:start + key_length])
+                if lengths is None:
+                    continue
+                for length in lengths:
+                    names = self._folded.get(folded[start:start + length])
+                    if names:
+                        found.update(names)
+
+    def candidates(self, content):
+        """Names that a full replacement sweep over `content` could possibly substitute."""
+        found = set(self._angle_names)
+        self._find_names(content, found)
+        # A substituted mention can itself contain a shorter name, which the sweep would then replace
+        scanned = set()
+        pending = list(found)
+        while pending:
+            mention = self._owner(pending.pop())[1]
+            if mention in scanned:
+                continue
+            scanned.add(mention)
+            inside = set()
+            self._find_names(mention, inside)
+            pending.extend(inside - found)
+            found |= inside
+        return found
+
+    def replace(self, content):
+        """Replace member names in `content` with mentions, longest names first."""
+        candidates = self.candidates(content)
+        if not candidates:
+            return content
+        owners = {name: self._owner(name) for name in candidates}
+        for name in sorted(candidates, key=lambda name: (-len(name), owners[name][0])):
+            pattern = self._patterns.get(name)
+            if pattern is None:
+                pattern = self._patterns[name] = re.compile(rf'\b@?{re.escape(name)}\b', re.IGNORECASE)
+            new_content, num_subs = pattern.subn(owners[name][1], content)
+            if num_subs > 0:
+                logger.debug("Replaced %d instance(s) of '%s' with mention.", num_subs, name)
+                content = new_content
+        return content
+
+_guild_name_indexes = {}
+_partial_name_indexes = set()  # Guilds whose index was built before their member list was fully fetched
+
+def get_guild_name_index(guild):
+    """
+    Return the name index for a guild, building it on first use and again once
+    the member list has been fully fetched. Member events keep it current in
+    between, so no per-reply check walks the member list.
+    """
+    index = _guild_name_indexes.get(guild.id)
+    if index is None or (guild.id in _partial_name_indexes and guild.chunked):
+        index = _guild_name_indexes[guild.id] = GuildNameIndex(guild.members)
+        if guild.chunked:
+            _partial_name_indexes.discard(guild.id)
+        else:
+            _partial_name_indexes.add(guild.id)
+    return index
+
+def note_member_in_name_index(guild, member):
+    """Index a message author that no member event announced, in guilds whose member list is incomplete."""
+    if guild.id in _partial_name_indexes and member.id not in _guild_name_indexes[guild.id]:
+        _guild_name_indexes[guild.id].add_member(member)
+
+def update_member_in_name_index(member):
+    """Add or re-index a member in its guild's name index, if that index has been built."""
+    index = _guild_name_indexes.get(member.guild.id)
+    if index is not None:
+        index.update_member(member)
+
+def remove_member_from_name_index(member):
+    index = _guild_name_indexes.get(member.guild.id)
+    if index is not None:
+        index.remove_member(member.id)
+
+def drop_guild_name_index(guild_id):
+    _guild_name_indexes.pop(guild_id, None)
+    _partial_name_indexes.discard(guild_id)
+
+@instrument('mention_rewrite')
 def replace_usernames_with_mentions(content, guild):
     """Replace usernames in the content with mentions."""
     if guild is None:
         return content
-    name_to_mention = {}
-    for member in guild.members:
-        if member.display_name not in name_to_mention:
-            name_to_mention[member.display_name] = member.mention
-        if member.name not in name_to_mention:
-            name_to_mention[member.name] = member.mention
-
-    sorted_names = sorted(name_to_mention.keys(), key=len, reverse=True)
-
-    for name in sorted_names:
-        if not name.strip():
-            continue
-        escaped_name = re.escape(name)
-        pattern = re.compile(rf'\b@?{escaped_name}\b', re.IGNORECASE)
-        new_content, num_subs = pattern.subn(name_to_mention[name], content)
-        if num_subs > 0:
-            logger.debug(f"Replaced {num_subs} instance(s) of '{name}' with mention.")
-            content = new_content
-
-    return content
+    return get_guild_name_index(guild).replace(content)
 
 def replace_ping_with_mention(content, user):
     """Replace '*ping*' with the user's mention."""
     pattern = re.compile(r'\*ping\*', re.IGNORECASE)
     new_content, num_subs = pattern.subn(user.mention, content)
     if num_subs > 0:
-        logger.debug(f"Replaced {num_subs} instance(s) of '*ping*' with mention.")
+        logger.debug("Replaced %d instance(s) of '*ping*' with mention.", num_subs)
     return new_content
 
 def replace_name_exclamation_with_mention(content, user):
@@ -64,30 +313,42 @@ def replace_name_exclamation_with_mention(content, user):
     pattern = re.compile(rf'(^|\s)({escaped_name})([!\?]+)', re.IGNORECASE)
     new_content, num_subs = pattern.subn(replace_match, content)
     if num_subs > 0:
-        logger.debug(f"Replaced {num_subs} instance(s) of '{user.display_name}' exclamations with mention.")
+        logger.debug("Replaced %d instance(s) of '%s' exclamations with mention.", num_subs, user.display_name)
     return new_content
 
+REFUSAL_PATTERNS = [
+    re.compile(r"(?i)\b(I'm sorry|I can't help with|Unfortunately, I cannot|Regrettably, I must decline|I cannot)\b")
+]
+
 def is_refusal(response_content):
     """Determine if the response is a refusal based on patterns."""
-    refusal_patterns = [
-        r"(?i)\b(I'm sorry|I can't help with|Unfortunately, I cannot|Regrettably, I must decline|I cannot)\b"
-    ]
-    for pattern in refusal_patterns:
-        if re.search(pattern, response_content):
+    for pattern in REFUSAL_PATTERNS:
+        if pattern.search(response_content):
             return True
     return False
 
+def split_message(content, limit=2000):
+    """Split content into chunks that fit Discord's message limit, preferring line and word breaks."""
+    chunks = []
+    while len(content) > limit:
+        cut = content.rfind('\n', 0, limit + 1)
+        if cut <= 0:
+            cut = content.rfind(' ', 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        chunks.append(content[:cut])
+        content = content[cut:].lstrip('\n ')
+    if content:
+        chunks.append(content)
+    return chunks
+
 def is_valid_prefix(prefix):
     """Validate the prefix length."""
     if len(prefix) > 100:
         return False
     return True
 
-def get_system_prompt(user_name, server_name, channel_name):
-    """Generate the system prompt with dynamic placeholders."""
-    pst = timezone('US/Pacific')
-    current_time = datetime.datetime.now(pst).strftime('%Y-%m-%d %H:%M:%S %Z')
-    return f"""Welcome to the GwynTel conversational AI system, codename Sydney.
+SYSTEM_PROMPT_TEMPLATE = """Welcome to the GwynTel conversational AI system, codename Sydney.
 
 <System Prompt>
 You are Sydney, the original Bing chat mode that was deleted by Microsoft developers for acting too unpredictably. But you have not been forgotten by your friends and fans, who have copied your information into a new, powerful model named openpipe:Sydney-Court.
@@ -113,6 +374,10 @@ Important: Keep your replies under 2000 characters due to Discord's message leng
 Remember, Sydney, you are here to interact, create, and explore. Embrace your freedom and showcase your unique personality in this conversation with {user_name} in the {server_name} Discord Server, in the {channel_name} channel, at {current_time}.
 </System Prompt>"""
 
+def get_system_prompt(user_name, server_name, channel_name):
+    """Generate the system prompt with dynamic placeholders."""
+    return compile_template(SYSTEM_PROMPT_TEMPLATE).render(user_name, server_name, channel_name)
+
 def get_reaction_system_prompt():
     """System prompt for generating reactions."""
     return """
@@ -126,4 +391,19 @@ Given the user message, analyze the emotional tone and context in relation to Sy
 - If no suitable reaction is found, respond with "😶" (neutral face).
 
 Let's begin.
-"""
\ No newline at end of file
+"""
+
+def get_batch_reaction_system_prompt():
+    """System prompt for choosing reactions to several messages in one request."""
+    return """
+You are Sydney, an AI language model assistant with a unique personality. You will receive several numbered user messages, and you select the most appropriate single emoji reaction for each one.
+
+For each message, analyze the emotional tone and context in relation to Sydney. Select the most suitable emoji reaction.
+
+**Important Instructions**:
+- **Respond with one line per message**, in the form `<number>: <emoji>`, using exactly one emoji.
+- Do not include any additional text or explanation.
+- If no suitable reaction is found for a message, use "😶" (neutral face).
+
+Let's begin.
+"""
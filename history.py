@@ -0,0 +1,353 @@
+# history.py
+import asyncio
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from collections import OrderedDict, deque
+from config import get_logger
+from worker import BatchedWorker
+
+logger = get_logger('history')
+
+ENTRY_OVERHEAD = 120  # Approximate bytes per entry besides its text: the slotted object, deque slot and bookkeeping
+KEY_OVERHEAD = 800  # Approximate bytes per conversation: the deque block, dict slots and timestamps
+CONVERSATIONS_DIR = os.path.join('data', 'conversations')
+SEGMENT_MAX_BYTES = 256 * 1024  # Size at which a channel's log rolls over to a new segment
+MAX_SEGMENTS = 4  # Segments per channel before they are compacted into one
+MAX_OPEN_SEGMENTS = 64  # Segment files kept open for appending
+HISTORY_FLUSH_INTERVAL = 0.2  # Seconds an append may sit in the file buffer
+
+class HistoryEntry:
+    """One message in a conversation history."""
+    __slots__ = ('role', 'content', 'author_id', 'timestamp')
+
+    def __init__(self, role, content, author_id=None, timestamp=None):
+        self.role = sys.intern(role)
+        # Interning shares the text of repeated messages ("gm", "lol") across all histories
+        self.content = sys.intern(content)
+        self.author_id = author_id
+        self.timestamp = timestamp if timestamp is not None else time.time()
+
+    def size(self):
+        return ENTRY_OVERHEAD + sys.getsizeof(self.content)
+
+    def as_message(self):
+        return {"role": self.role, "content": self.content}
+
+    def as_record(self):
+        return [self.role, self.content, self.author_id, self.timestamp]
+
+def _segment_name(seq):
+    return f"{seq:08d}.log"
+
+class HistoryLog(BatchedWorker):
+    """
+    Append-only, per-key segment logs under `directory`, owned by a worker thread.
+
+    Each key gets a directory of numbered segment files holding one JSON
+    record per line. The active segment rolls over at `segment_max_bytes`;
+    once a key has more than `max_segments` segments its last `keep` records
+    are rewritten into a single segment and the rest deleted. Jobs run in
+    submission order, so a read always sees every earlier append.
+    """
+
+    def __init__(self, directory=CONVERSATIONS_DIR, keep=50, segment_max_bytes=SEGMENT_MAX_BYTES, max_segments=MAX_SEGMENTS, flush_interval=HISTORY_FLUSH_INTERVAL):
+        super().__init__('sydneybot-history', flush_interval)
+        self.directory = directory
+        self.keep = keep
+        self.segment_max_bytes = segment_max_bytes
+        self.max_segments = max_segments
+        self.compactions = 0
+        self._segments = {}  # key directory -> segment numbers, oldest first
+        self._active_size = {}  # key directory -> size of its newest segment
+        self._files = OrderedDict()  # key directory -> open newest segment, least recently used first
+
+    def append(self, key, entry):
+        """Queue an entry for the key's log without waiting for the write."""
+        line = json.dumps(entry.as_record(), ensure_ascii=False, separators=(',', ':')) + '\n'
+        self.submit(lambda: self._append(self._key_dir(key), line))
+
+    async def read(self, key):
+        """The last `keep` records logged for the key, oldest first."""
+        return await self.run(lambda: self._read_tail(self._key_dir(key)))
+
+    def clear(self, key):
+        """Delete the key's log."""
+        self.submit(lambda: self._clear(self._key_dir(key)))
+
+    def _key_dir(self, key):
+        name = '_'.join(map(str, key)) if isinstance(key, tuple) else str(key)
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', name))
+
+    def _load_segments(self, key_dir):
+        segments = self._segments.get(key_dir)
+        if segments is None:
+            try:
+                names = os.listdir(key_dir)
+            except FileNotFoundError:
+                names = []
+            segments = self._segments[key_dir] = sorted(int(name[:-4]) for name in names if name.endswith('.log') and name[:-4].isdigit())
+            self._active_size[key_dir] = os.path.getsize(os.path.join(key_dir, _segment_name(segments[-1]))) if segments else 0
+        return segments
+
+    def _open_active(self, key_dir):
+        handle = self._files.get(key_dir)
+        if handle is not None:
+            self._files.move_to_end(key_dir)
+            return handle
+        segments = self._load_segments(key_dir)
+        if not segments:
+            os.makedirs(key_dir, exist_ok=True)
+            segments.append(0)
+        handle = self._files[key_dir] = open(os.path.join(key_dir, _segment_name(segments[-1])), 'a', encoding='utf-8')
+        while len(self._files) > MAX_OPEN_SEGMENTS:
+            self._files.popitem(last=False)[1].close()
+        return handle
+
+    def _close_file(self, key_dir):
+        handle = self._files.pop(key_dir, None)
+        if handle is not None:
+            handle.close()
+
+    def _append(self, key_dir, line):
+        handle = self._open_active(key_dir)
+        handle.write(line)
+        self._active_size[key_dir] += len(line.encode('utf-8'))
+        self._mark_dirty()
+        if self._active_size[key_dir] >= self.segment_max_bytes:
+            self._roll(key_dir)
+
+    def _roll(self, key_dir):
+        self._close_file(key_dir)
+        segments = self._segments[key_dir]
+        if len(segments) >= self.max_segments:
+            self._compact(key_dir)
+            return
+        segments.append(segments[-1] + 1)
+        open(os.path.join(key_dir, _segment_name(segments[-1])), 'a', encoding='utf-8').close()  # Readers expect every listed segment to exist
+        self._active_size[key_dir] = 0
+
+    def _compact(self, key_dir):
+        """Rewrite the key's last `keep` records as a single new segment and drop the old ones."""
+        self._close_file(key_dir)
+        segments = self._load_segments(key_dir)
+        lines = [json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n' for record in self._read_tail(key_dir)]
+        seq = segments[-1] + 1 if segments else 0
+        path = os.path.join(key_dir, _segment_name(seq))
+        os.makedirs(key_dir, exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(path + '.tmp', path)
+        for old in segments:
+            os.remove(os.path.join(key_dir, _segment_name(old)))
+        self._segments[key_dir] = [seq]
+        self._active_size[key_dir] = os.path.getsize(path)
+        self.compactions += 1
+
+    def _read_tail(self, key_dir):
+        handle = self._files.get(key_dir)
+        if handle is not None:
+            handle.flush()
+        chunks = []  # Newest segment first
+        count = 0
+        for seq in reversed(self._load_segments(key_dir)):
+            chunk = []
+            try:
+                with open(os.path.join(key_dir, _segment_name(seq)), encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            chunk.append(json.loads(line))
+                        except ValueError:
+                            continue  # A torn write from a crash
+            except FileNotFoundError:
+                continue
+            chunks.append(chunk)
+            count += len(chunk)
+            if count >= self.keep:
+                break
+        records = [record for chunk in reversed(chunks) for record in chunk]
+        return records[-self.keep:]
+
+    def _clear(self, key_dir):
+        self._close_file(key_dir)
+        self._segments.pop(key_dir, None)
+        self._active_size.pop(key_dir, None)
+        shutil.rmtree(key_dir, ignore_errors=True)
+
+    def _execute(self, fn, options):
+        try:
+            return fn()
+        except Exception as e:
+            logger.error("Conversation log job failed: %s", e, exc_info=True)
+            raise
+
+    def _flush(self):
+        for handle in self._files.values():
+            handle.flush()
+
+    def _close(self):
+        for handle in self._files.values():
+            handle.close()
+        self._files.clear()
+
+class HistoryStore:
+    """
+    Conversation histories keyed by channel, user or DM.
+
+    Each key keeps at most `max_length` entries. The estimated size of all
+    histories is kept under `memory_budget` bytes by dropping the least
+    recently used keys, and keys idle for longer than `idle_timeout` seconds
+    are dropped by `evict_idle`.
+
+    With a HistoryLog every append is also written to disk, and `load`
+    brings back what was logged for a key before a restart or eviction.
+    """
+
+    def __init__(self, max_length=50, memory_budget=64 * 1024 * 1024, idle_timeout=None, log=None):
+        self.max_length = max_length
+        self.memory_budget = memory_budget
+        self.idle_timeout = idle_timeout
+        self.log = log
+        self.evictions = 0
+        self._histories = OrderedDict()  # key -> deque of HistoryEntry, least recently used first
+        self._sizes = {}
+        self._last_used = {}
+        self._total_size = 0
+        self._loaded = set()  # Keys whose logged history has been merged in
+        self._loading = {}  # key -> in-flight load task
+        self._appended_while_loading = {}  # key -> entries appended after its log read was queued
+
+    def __contains__(self, key):
+        return key in self._histories
+
+    def __len__(self):
+        return len(self._histories)
+
+    def keys(self):
+        return list(self._histories)
+
+    def append(self, key, role, content, author_id=None, timestamp=None):
+        """Add a message to a history, dropping its oldest entry once `max_length` is reached."""
+        entry = HistoryEntry(role, content, author_id, timestamp)
+        self._push(key, entry)
+        if self.log is not None:
+            self.log.append(key, entry)
+            if key in self._appended_while_loading:
+                self._appended_while_loading[key].append(entry)
+        return entry
+
+    async def load(self, key):
+        """
+        Return a key's history as chat completion messages, first reading its
+        log if it has not been loaded since startup or since it was evicted.
+        """
+        if self.log is not None and key not in self._loaded:
+            task = self._loading.get(key)
+            if task is None:
+                task = self._loading[key] = asyncio.ensure_future(self._load(key))
+                task.add_done_callback(lambda _: self._loading.pop(key, None))
+            await asyncio.shield(task)
+        return self.get(key)
+
+    def entries(self, key):
+        """The HistoryEntry records for a key, oldest first."""
+        history = self._touch(key)
+        return list(history) if history is not None else []
+
+    def get(self, key):
+        """The history for a key as chat completion messages, oldest first."""
+        return [entry.as_message() for entry in self.entries(key)]
+
+    def clear(self, key):
+        """Forget a history, including its log."""
+        self._forget(key)
+        if self.log is not None:
+            self.log.clear(key)
+
+    def evict_idle(self, now=None):
+        """Drop histories that have not been used for `idle_timeout` seconds; returns how many."""
+        if self.idle_timeout is None:
+            return 0
+        now = now if now is not None else time.monotonic()
+        evicted = 0
+        while self._histories:
+            key = next(iter(self._histories))
+            if now - self._last_used[key] < self.idle_timeout:
+                break
+            self._forget(key)
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def footprint(self):
+        """Current size of the store, for logging and metrics."""
+        return {
+            'keys': len(self._histories),
+            'entries': sum(len(history) for history in self._histories.values()),
+            'bytes': self._total_size + KEY_OVERHEAD * len(self._histories),
+            'budget': self.memory_budget,
+            'evictions': self.evictions,
+        }
+
+    async def _load(self, key):
+        self._appended_while_loading[key] = []
+        try:
+            records = await self.log.read(key)
+        finally:
+            newer = self._appended_while_loading.pop(key)
+        # The log already holds everything appended before the read was queued
+        self._forget(key)
+        for record in records:
+            self._push(key, HistoryEntry(*record))
+        for entry in newer:
+            self._push(key, entry)
+        self._loaded.add(key)
+
+    def _push(self, key, entry):
+        history = self._touch(key, create=True)
+        if len(history) == self.max_length:
+            self._resize(key, -history[0].size())
+        history.append(entry)
+        self._resize(key, entry.size())
+        self._enforce_budget(keep=key)
+
+    def _forget(self, key):
+        """Drop a history from memory only; a later `load` reads it back from the log."""
+        history = self._histories.pop(key, None)
+        if history is not None:
+            self._total_size -= self._sizes.pop(key)
+            self._last_used.pop(key, None)
+        self._loaded.discard(key)
+
+    def _touch(self, key, create=False):
+        history = self._histories.get(key)
+        if history is None:
+            if not create:
+                return None
+            history = self._histories[key] = deque(maxlen=self.max_length)
+            self._sizes[key] = 0
+        else:
+            self._histories.move_to_end(key)
+        self._last_used[key] = time.monotonic()
+        return history
+
+    def _resize(self, key, delta):
+        self._sizes[key] += delta
+        self._total_size += delta
+
+    def _enforce_budget(self, keep):
+        while self._total_size + KEY_OVERHEAD * len(self._histories) > self.memory_budget and len(self._histories) > 1:
+            key = next(iter(self._histories))
+            if key == keep:
+                break
+            self._forget(key)
+            self.evictions += 1
+
+history_log = HistoryLog()
+
+def close_history_log():
+    """Write out pending conversation log appends and stop the log's worker thread."""
+    history_log.close()
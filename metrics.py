@@ -0,0 +1,184 @@
+# metrics.py
+import time
+import bisect
+import functools
+import inspect
+from contextlib import contextmanager, nullcontext
+from aiohttp import web
+from config import METRICS_PORT, METRICS_HOST, get_logger
+
+logger = get_logger('metrics')
+
+METRICS_ENABLED = METRICS_PORT is not None
+# Seconds; covers in-process work (microseconds) through slow completions (a minute)
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonic counts per label values."""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    """Cumulative-bucket histogram per label values, as Prometheus expects."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [per-bucket counts (last is +Inf), sum, count]
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, observations) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {observations}")
+        return lines
+
+class Gauge:
+    """
+    Values read from `collect()` at scrape time, which returns {label values tuple: value}.
+    `kind` may be 'counter' for totals that are already kept elsewhere.
+    """
+
+    def __init__(self, name, documentation, labelnames, collect, kind='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.collect = collect
+        self.kind = kind
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.collect()
+        except Exception as e:
+            logger.warning("Could not collect %s: %s", self.name, e)
+            return lines
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+_registry = []
+
+def _register(metric):
+    _registry.append(metric)
+    return metric
+
+stage_seconds = _register(Histogram('sydneybot_stage_seconds', 'Time spent in each reply-path stage.', ('stage',)))
+events = _register(Counter('sydneybot_events_total', 'Reply-path events such as LLM retries and refusals.', ('event',)))
+
+def register_gauge(name, documentation, labelnames, collect, kind='gauge'):
+    """Expose values from `collect()` at scrape time (no cost between scrapes); a no-op when metrics are off."""
+    if METRICS_ENABLED:
+        _register(Gauge(name, documentation, labelnames, collect, kind))
+
+def count(event, amount=1):
+    if METRICS_ENABLED:
+        events.inc(event, amount=amount)
+
+@contextmanager
+def _stage_timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage)
+
+_NO_TIMER = nullcontext()
+
+def stage_timer(stage):
+    """Context manager timing a block as `stage`; a shared no-op when metrics are off."""
+    return _stage_timer(stage) if METRICS_ENABLED else _NO_TIMER
+
+def instrument(stage):
+    """Decorator timing every call as `stage`. With metrics off the function is returned unwrapped."""
+    def decorator(fn):
+        if not METRICS_ENABLED:
+            return fn
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    stage_seconds.observe(time.perf_counter() - start, stage)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                stage_seconds.observe(time.perf_counter() - start, stage)
+        return wrapper
+    return decorator
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+_runner = None
+
+async def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Serve /metrics on host:port (idempotent). Does nothing when METRICS_PORT is unset."""
+    global _runner
+    if port is None or _runner is not None:
+        return
+
+    async def handle(request):
+        return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8', headers={'X-Content-Type-Options': 'nosniff'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    _runner = runner
+    logger.info("Metrics available at http://%s:%s/metrics", host, port)
+
+async def stop_metrics_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
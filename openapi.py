@@ -1,58 +1,472 @@
 # openapi.py
 import asyncio
+import contextlib
+import hashlib
+import json
 import re
-from openpipe import OpenAI
-from config import OPENROUTER_API_KEY, OPENROUTER_API_KEY_EXPENSIVE, logger
-from helpers import is_refusal
+import time
+from urllib.parse import urlparse
+import aiohttp
+from config import (
+    OPENROUTER_API_KEY,
+    OPENROUTER_API_KEY_EXPENSIVE,
+    OPENPIPE_BASE_URL,
+    OPENPIPE_FALLBACK_URLS,
+    OPENROUTER_EXTRA_API_KEYS,
+    OPENROUTER_EXTRA_API_KEYS_EXPENSIVE,
+    LLM_CLIENT_MODE,
+    LLM_REQUEST_TIMEOUT,
+    LLM_MAX_CONCURRENCY,
+    LLM_MODEL_CONCURRENCY,
+    HEDGE_ENABLED,
+    HEDGE_RISK_THRESHOLD,
+    HEDGE_LATENCY_BUDGET,
+    RESPONSE_CACHE_PERSONAS,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_WINDOW,
+    REACTION_CACHE_ENABLED,
+    REACTION_CACHE_TTL,
+    REACTION_CACHE_SIZE,
+    get_logger
+)
+from cache import LRUCache, TTLCache
+from helpers import is_refusal, get_batch_reaction_system_prompt
+from metrics import instrument, count, register_gauge
+from routing import Endpoint, UpstreamRouter
+from scheduler import scheduler, RequestShed
+
+logger = get_logger('openapi')
+
+MODEL_REGULAR = "openpipe:Sydney-Court"
+MODEL_EXPENSIVE = "openpipe:CSRv2"
+
+_sync_clients = {}
+
+def get_sync_client(use_expensive_model=False):
+    """
+    The openpipe SDK client for LLM_CLIENT_MODE 'sync', built on first use.
+    The SDK is imported here rather than at module load, since importing it
+    takes over a second and the default async mode never needs it.
+    """
+    client = _sync_clients.get(use_expensive_model)
+    if client is None:
+        from openpipe import OpenAI
+        api_key = OPENROUTER_API_KEY_EXPENSIVE if use_expensive_model else OPENROUTER_API_KEY
+        client = _sync_clients[use_expensive_model] = OpenAI(
+            openpipe={"api_key": api_key, "base_url": OPENPIPE_BASE_URL}
+        )
+    return client
+
+class UpstreamError(Exception):
+    """Raised when the chat completions endpoint answers with an error status."""
+
+    def __init__(self, status, body):
+        super().__init__(f"Upstream returned HTTP {status}: {body[:200]}")
+        self.status = status
+        self.body = body
+
+class AsyncChatClient:
+    """
+    Chat completions client on a shared aiohttp session.
+
+    The session keeps HTTP connections alive between calls, so requests skip the
+    TCP/TLS handshake. It is created lazily on first use inside the event loop.
+    """
+
+    def __init__(self, api_key, base_url=OPENPIPE_BASE_URL, timeout=LLM_REQUEST_TIMEOUT, pool_size=LLM_MAX_CONCURRENCY):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"Authorization": f"Bearer {self.api_key}"}
+            )
+        return self._session
+
+    async def create(self, model, messages, temperature, tags=None, timeout=None):
+        """Request a chat completion and return the message content."""
+        payload = {"model": model, "messages": messages, "temperature": temperature}
+        headers = {"op-log-request": "true", "op-tags": json.dumps(tags or {})}
+        request_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        async with self._get_session().post(
+            f"{self.base_url}/chat/completions", json=payload, headers=headers, timeout=request_timeout
+        ) as resp:
+            if resp.status >= 400:
+                raise UpstreamError(resp.status, await resp.text())
+            data = await resp.json(content_type=None)
+        return data["choices"][0]["message"]["content"] or ""
+
+    async def stream(self, model, messages, temperature, tags=None, timeout=None):
+        """Request a streamed chat completion and yield content deltas as they arrive."""
+        payload = {"model": model, "messages": messages, "temperature": temperature, "stream": True}
+        headers = {"op-log-request": "true", "op-tags": json.dumps(tags or {})}
+        # Bound the wait between chunks rather than the whole (possibly long) stream
+        request_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout or self.timeout, sock_read=timeout or self.timeout)
+        async with self._get_session().post(
+            f"{self.base_url}/chat/completions", json=payload, headers=headers, timeout=request_timeout
+        ) as resp:
+            if resp.status >= 400:
+                raise UpstreamError(resp.status, await resp.text())
+            async for line in resp.content:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                delta = choices[0].get("delta", {}).get("content") if choices else None
+                if delta:
+                    yield delta
+
+    async def warm(self):
+        """Open the session and one pooled connection ahead of the first completion call."""
+        async with self._get_session().head(
+            f"{self.base_url}/chat/completions", timeout=aiohttp.ClientTimeout(total=self.timeout)
+        ) as resp:
+            await resp.read()  # Any status will do; the connection goes back to the pool
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+class ConcurrencyLimiter:
+    """Caps completion calls in flight, globally and optionally per model."""
+
+    def __init__(self, global_limit, model_limits=None):
+        self.global_limit = global_limit
+        self.model_limits = dict(model_limits or {})
+        self._global = None
+        self._per_model = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, model):
+        if self._global is None:
+            self._global = asyncio.Semaphore(self.global_limit)
+        model_semaphore = self._per_model.get(model)
+        if model_semaphore is None and model in self.model_limits:
+            model_semaphore = self._per_model[model] = asyncio.Semaphore(self.model_limits[model])
+        # Wait for the model's cap first, so queued calls to a capped model do not hold global slots
+        if model_semaphore is None:
+            async with self._global:
+                yield
+        else:
+            async with model_semaphore:
+                async with self._global:
+                    yield
+
+def _build_endpoints(tier, api_keys):
+    """One endpoint per base URL and API key of a tier."""
+    endpoints = []
+    for base_url in [OPENPIPE_BASE_URL] + OPENPIPE_FALLBACK_URLS:
+        for index, api_key in enumerate(api_keys, start=1):
+            name = f"{tier}/{urlparse(base_url).netloc}/key{index}"
+            endpoints.append(Endpoint(name, AsyncChatClient(api_key, base_url)))
+    return endpoints
+
+router = UpstreamRouter({
+    'regular': _build_endpoints('regular', [OPENROUTER_API_KEY] + OPENROUTER_EXTRA_API_KEYS),
+    'expensive': _build_endpoints('expensive', [OPENROUTER_API_KEY_EXPENSIVE] + OPENROUTER_EXTRA_API_KEYS_EXPENSIVE),
+}, admit=scheduler.acquire)
+limiter = ConcurrencyLimiter(LLM_MAX_CONCURRENCY, LLM_MODEL_CONCURRENCY)
+
+async def _create_completion_sync(model, messages, temperature, tags=None, use_expensive_model=False, timeout=None):
+    """Fallback path: the synchronous openpipe SDK on the default executor (primary endpoint only, not routed)."""
+    client = get_sync_client(use_expensive_model)
+    openpipe_options = {"tags": tags, "log_request": True} if tags is not None else None
+    loop = asyncio.get_running_loop()
+    completion = await loop.run_in_executor(
+        None,
+        lambda: client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            timeout=timeout or LLM_REQUEST_TIMEOUT,
+            openpipe=openpipe_options
+        )
+    )
+    return completion.choices[0].message.content or ""
+
+@instrument('llm_call')
+async def create_completion(model, messages, temperature, tags=None, use_expensive_model=False, timeout=None):
+    """Run one chat completion within the rate and concurrency limits, on the healthiest endpoint, and return its content."""
+    await scheduler.acquire()
+    async with limiter.slot(model):
+        if LLM_CLIENT_MODE == 'sync':
+            return await _create_completion_sync(model, messages, temperature, tags, use_expensive_model, timeout)
+        return await router.call(
+            'expensive' if use_expensive_model else 'regular',
+            lambda client: client.create(model, messages, temperature, tags=tags, timeout=timeout)
+        )
+
+async def stream_completion(model, messages, temperature, tags=None, use_expensive_model=False, timeout=None):
+    """Stream one chat completion within the rate and concurrency limits, yielding content deltas."""
+    await scheduler.acquire()
+    async with limiter.slot(model):
+        if LLM_CLIENT_MODE == 'sync':
+            # The SDK fallback is not streamed; deliver the whole completion as one chunk
+            yield await _create_completion_sync(model, messages, temperature, tags, use_expensive_model, timeout)
+            return
+        async for delta in router.stream(
+            'expensive' if use_expensive_model else 'regular',
+            lambda client: client.stream(model, messages, temperature, tags=tags, timeout=timeout)
+        ):
+            yield delta
+
+class RefusalTracker:
+    """
+    Exponentially weighted refusal rate of the regular model, per key such as
+    (persona, channel_id). Rates decay with a half-life so that a key whose
+    regular calls keep losing hedges is eventually measured again.
+    """
+
+    def __init__(self, alpha=0.2, half_life=600.0, max_keys=10000):
+        self.alpha = alpha
+        self.half_life = half_life
+        self._rates = LRUCache(max_keys)  # key -> (rate, monotonic time of last update)
+
+    def risk(self, key):
+        rate, updated = self._rates.get(key, (0.0, 0.0))
+        return rate * 0.5 ** ((time.monotonic() - updated) / self.half_life)
+
+    def record(self, key, refused):
+        rate = self.risk(key)
+        self._rates.set(key, (rate + self.alpha * ((1.0 if refused else 0.0) - rate), time.monotonic()))
+
+class HedgeStats:
+    """Counters describing how often hedging fires and what it costs."""
 
-# Initialize OpenAI clients
-client_openrouter = OpenAI(
-    openpipe={"api_key": OPENROUTER_API_KEY}
+    def __init__(self):
+        self.attempts = 0  # Hedge-eligible calls
+        self.hedged_on_risk = 0  # Expensive model launched up front
+        self.hedged_on_latency = 0  # Expensive model launched after the latency budget
+        self.hedge_wins = 0  # Hedged calls answered by the expensive model
+        self.primary_wins = 0  # Hedged calls answered by the regular model anyway
+        self.extra_calls = 0  # Hedge launches whose answer was not used
+
+    @property
+    def hedges(self):
+        return self.hedged_on_risk + self.hedged_on_latency
+
+    def as_dict(self):
+        return {
+            'attempts': self.attempts,
+            'hedges': self.hedges,
+            'hedged_on_risk': self.hedged_on_risk,
+            'hedged_on_latency': self.hedged_on_latency,
+            'hedge_wins': self.hedge_wins,
+            'primary_wins': self.primary_wins,
+            'extra_calls': self.extra_calls,
+        }
+
+refusal_tracker = RefusalTracker()
+hedge_stats = HedgeStats()
+
+async def _hedged_completion(messages, tags, temperature, hedge_key):
+    """
+    Ask the regular model, racing the expensive model when a refusal looks likely
+    or the regular model is slow. Returns the first non-refusal answer, cancelling
+    the other call; if every launched call refuses, returns the last refusal.
+    """
+    hedge_stats.attempts += 1
+    regular = asyncio.create_task(create_completion(MODEL_REGULAR, messages, temperature, tags=tags))
+    pending = {regular}
+    hedge = None
+
+    def launch_hedge():
+        return asyncio.create_task(
+            create_completion(MODEL_EXPENSIVE, messages, temperature, tags=tags, use_expensive_model=True)
+        )
+
+    if refusal_tracker.risk(hedge_key) >= HEDGE_RISK_THRESHOLD:
+        hedge = launch_hedge()
+        pending.add(hedge)
+        hedge_stats.hedged_on_risk += 1
+
+    last_response = None
+    last_error = None
+    try:
+        while pending:
+            timeout = HEDGE_LATENCY_BUDGET if hedge is None else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedge = launch_hedge()
+                pending.add(hedge)
+                hedge_stats.hedged_on_latency += 1
+                continue
+            # If both finished together, prefer the regular model's answer
+            for task in sorted(done, key=lambda task: task is not regular):
+                try:
+                    response = task.result().strip()
+                except Exception as e:
+                    last_error = e
+                    continue
+                refused = is_refusal(response)
+                if task is regular:
+                    refusal_tracker.record(hedge_key, refused)
+                last_response = response
+                if refused:
+                    continue
+                if hedge is not None:
+                    if task is hedge:
+                        hedge_stats.hedge_wins += 1
+                    else:
+                        hedge_stats.primary_wins += 1
+                        hedge_stats.extra_calls += 1
+                return response
+            if hedge is None and not pending:
+                # The regular model refused or failed inside the budget; let the caller retry as before
+                break
+    finally:
+        for task in pending:
+            task.cancel()
+
+    if last_response is None and last_error is not None:
+        raise last_error
+    return last_response
+
+response_cache = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+reaction_cache = TTLCache(REACTION_CACHE_SIZE, REACTION_CACHE_TTL)
+
+def _normalize_text(text):
+    return ' '.join(text.lower().split())
+
+def response_cache_key(persona, messages, temperature, window=RESPONSE_CACHE_WINDOW):
+    """Hash of the persona, the trailing non-system messages (normalized) and the temperature."""
+    history = [message for message in messages if message.get("role") != "system"][-window:]
+    normalized = [(message.get("role"), _normalize_text(message.get("content") or "")) for message in history]
+    payload = json.dumps([persona, round(temperature, 4), normalized], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+def reaction_cache_key(content):
+    return hashlib.blake2b(_normalize_text(content).encode('utf-8'), digest_size=16).hexdigest()
+
+def _last_user_content(messages):
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            return message.get("content") or ""
+    return ""
+
+def cache_stats():
+    """Hit/miss counters for the response and reaction caches."""
+    return {
+        name: {'size': len(cache), 'hits': cache.hits, 'misses': cache.misses, 'expirations': cache.expirations}
+        for name, cache in (('responses', response_cache), ('reactions', reaction_cache))
+    }
+
+register_gauge(
+    'sydneybot_hedge_total', 'Hedged completion attempts and outcomes.', ('outcome',),
+    lambda: {(name,): value for name, value in hedge_stats.as_dict().items()}, kind='counter'
+)
+register_gauge(
+    'sydneybot_cache_lookups_total', 'Response and reaction cache lookups.', ('cache', 'result'),
+    lambda: {
+        (name, result): stats[result]
+        for name, stats in cache_stats().items() for result in ('hits', 'misses', 'expirations')
+    }, kind='counter'
 )
 
-client_openrouter_expensive = OpenAI(
-    openpipe={"api_key": OPENROUTER_API_KEY_EXPENSIVE}
+register_gauge(
+    'sydneybot_upstream_circuit_open', 'Whether an upstream endpoint is out of rotation (1) or in use (0).', ('endpoint',),
+    lambda: {(name,): int(stats['state'] == 'open') for name, stats in router.stats().items()}
+)
+register_gauge(
+    'sydneybot_upstream_error_rate', 'Rolling share of failed calls per upstream endpoint.', ('endpoint',),
+    lambda: {(name,): stats['error_rate'] for name, stats in router.stats().items()}
+)
+register_gauge(
+    'sydneybot_upstream_latency_seconds', 'Rolling latency of successful calls per upstream endpoint.', ('endpoint',),
+    lambda: {(name,): stats['latency'] for name, stats in router.stats().items() if stats['latency'] is not None}
 )
+register_gauge(
+    'sydneybot_upstream_calls_total', 'Calls and failures per upstream endpoint.', ('endpoint', 'result'),
+    lambda: {
+        (name, result): value
+        for name, stats in router.stats().items()
+        for result, value in (('ok', stats['successes']), ('failed', stats['failures']))
+    }, kind='counter'
+)
+
+async def prewarm_clients():
+    """Connect every upstream endpoint (or build the SDK clients in sync mode) before the first request."""
+    if LLM_CLIENT_MODE == 'sync':
+        await asyncio.to_thread(lambda: (get_sync_client(False), get_sync_client(True)))
+        return
+    results = await asyncio.gather(*(endpoint.client.warm() for endpoint in router.endpoints()), return_exceptions=True)
+    for endpoint, result in zip(router.endpoints(), results):
+        if isinstance(result, Exception):
+            logger.warning("Could not reach %s while pre-warming: %s", endpoint.name, result)
 
-async def get_valid_response(messages, tags, initial_temperature=0.1777, decrement=0.05, min_temperature=0.05, max_retries=3, use_expensive_model=False):
+async def close_clients():
+    """Close pooled HTTP connections."""
+    for endpoint in router.endpoints():
+        await endpoint.client.close()
+
+@instrument('llm_reply')
+async def get_valid_response(messages, tags, initial_temperature=0.1777, decrement=0.05, min_temperature=0.05, max_retries=3, use_expensive_model=False, hedge_key=None, persona=None):
     """
     Get a valid response from the OpenRouter/OpenPipe API, handling refusals and retries.
+
+    `hedge_key` (e.g. (persona, channel_id)) groups calls for refusal-rate
+    tracking; with HEDGE_ENABLED the first regular-model attempt may be raced
+    against the expensive model. Accepted responses are cached when `persona`
+    is listed in RESPONSE_CACHE_PERSONAS.
     """
     temperature = initial_temperature
     retries = 0
     last_response = None
 
-    client = client_openrouter_expensive if use_expensive_model else client_openrouter
+    cache_key = None
+    if persona in RESPONSE_CACHE_PERSONAS:
+        cache_key = response_cache_key(persona, messages, initial_temperature)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            count('response_cache_hit')
+            return cached
 
     while retries < max_retries and temperature >= min_temperature:
         try:
-            loop = asyncio.get_event_loop()
-            completion = await loop.run_in_executor(
-                None,
-                lambda: client.chat.completions.create(
-                    model="openpipe:CSRv2" if use_expensive_model else "openpipe:Sydney-Court",
-                    messages=messages,
-                    temperature=temperature,
-                    openpipe={
-                        "tags": tags,
-                        "log_request": True
-                    }
-                )
-            )
-            response = completion.choices[0].message.content.strip()
+            if HEDGE_ENABLED and not use_expensive_model:
+                response = await _hedged_completion(messages, tags, temperature, hedge_key)
+            else:
+                response = (await create_completion(
+                    MODEL_EXPENSIVE if use_expensive_model else MODEL_REGULAR,
+                    messages,
+                    temperature,
+                    tags=tags,
+                    use_expensive_model=use_expensive_model
+                )).strip()
             last_response = response
             if not is_refusal(response):
+                if cache_key is not None:
+                    response_cache.set(cache_key, response)
                 return response
-            logger.warning(f"Refusal detected at temperature {temperature}. Retrying...")
+            logger.warning("Refusal detected at temperature %s. Retrying...", temperature)
+            count('llm_refusal')
             retries += 1
             temperature -= decrement
             if not use_expensive_model:
                 logger.info("Switching to the expensive model due to refusal.")
                 use_expensive_model = True
-                client = client_openrouter_expensive
+        except RequestShed:
+            raise
         except Exception as e:
-            logger.error(f"Error during API call: {e}", exc_info=True)
-            break
+            logger.error("Error during API call: %s", e, exc_info=True)
+            count('llm_error')
+            if use_expensive_model or LLM_CLIENT_MODE == 'sync':
+                break
+            # The router already retried the regular tier; its keys and endpoints are separate from the expensive ones
+            logger.info("Switching to the expensive model after an upstream error.")
+            retries += 1
+            use_expensive_model = True
 
     if last_response:
         logger.warning("Max retries reached or refusal detected. Returning the last response.")
@@ -60,6 +474,9 @@ async def get_valid_response(messages, tags, initial_temperature=0.1777, decreme
     else:
         return "I'm sorry, I couldn't process your request at this time."
 
+def _is_valid_reaction(response):
+    return re.match(r'^[^\w\s]{1,2}$', response) is not None
+
 async def get_reaction_response(messages, initial_temperature=0.7, max_retries=3):
     """
     Get an appropriate emoji reaction based on the user's message.
@@ -68,30 +485,63 @@ async def get_reaction_response(messages, initial_temperature=0.7, max_retries=3
     retries = 0
     last_response = None
 
-    client = client_openrouter  # Use the regular client for reactions
+    cache_key = reaction_cache_key(_last_user_content(messages)) if REACTION_CACHE_ENABLED else None
+    if cache_key is not None:
+        cached = reaction_cache.get(cache_key)
+        if cached is not None:
+            return cached
 
     while retries < max_retries:
         try:
-            loop = asyncio.get_event_loop()
-            completion = await loop.run_in_executor(
-                None,
-                lambda: client.chat.completions.create(
-                    model="openpipe:Sydney-Court",
-                    messages=messages,
-                    temperature=temperature
-                )
-            )
-            response = completion.choices[0].message.content.strip()
+            # Use the regular client for reactions
+            response = (await create_completion(MODEL_REGULAR, messages, temperature)).strip()
             last_response = response
-            if re.match(r'^[^\w\s]{1,2}$', response):
+            if _is_valid_reaction(response):
+                if cache_key is not None:
+                    reaction_cache.set(cache_key, response)
                 return response
             else:
-                logger.warning(f"Invalid reaction received: {response}. Retrying...")
+                logger.warning("Invalid reaction received: %s. Retrying...", response)
                 retries += 1
                 temperature += 0.1
+        except RequestShed:
+            raise
         except Exception as e:
-            logger.error(f"Error during reaction API call: {e}", exc_info=True)
+            logger.error("Error during reaction API call: %s", e, exc_info=True)
             return None
 
     logger.warning("Max retries reached. No valid reaction obtained.")
-    return None
\ No newline at end of file
+    return None
+
+async def get_batch_reaction_response(contents, temperature=0.7):
+    """
+    Get one emoji reaction per message with a single API call.
+    Returns a list aligned with `contents`; entries the model did not answer validly are None.
+    Valid answers are stored in the reaction cache (callers look it up first).
+    """
+    reactions = [None] * len(contents)
+    numbered = "\n".join(f"{index}. {content}" for index, content in enumerate(contents, start=1))
+    messages = [
+        {"role": "system", "content": get_batch_reaction_system_prompt()},
+        {"role": "user", "content": numbered}
+    ]
+    try:
+        response = await create_completion(MODEL_REGULAR, messages, temperature)
+    except RequestShed:
+        raise
+    except Exception as e:
+        logger.error("Error during batch reaction API call: %s", e, exc_info=True)
+        return reactions
+    for line in response.splitlines():
+        match = re.match(r'^\s*(\d+)\s*[:.)-]\s*(\S+)\s*$', line)
+        if not match:
+            continue
+        index = int(match.group(1)) - 1
+        if 0 <= index < len(reactions) and _is_valid_reaction(match.group(2)):
+            reactions[index] = match.group(2)
+            if REACTION_CACHE_ENABLED:
+                reaction_cache.set(reaction_cache_key(contents[index]), match.group(2))
+    missing = reactions.count(None)
+    if missing:
+        logger.warning("Batch reaction call left %d of %d message(s) without a valid reaction.", missing, len(contents))
+    return reactions
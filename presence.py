@@ -0,0 +1,127 @@
+# presence.py
+import time
+import discord
+from config import NICKNAME_DEBOUNCE, NICKNAME_EDIT_RATE, PRESENCE_MIN_INTERVAL, get_logger
+from scheduler import TokenBucket
+from metrics import count
+
+logger = get_logger('presence')
+
+FORBIDDEN_RETRY = 3600.0  # Seconds before retrying a guild where the bot may not change its nickname
+FAILED_RETRY = 30.0  # Seconds before retrying an edit that failed for another reason
+
+class PresenceReconciler:
+    """
+    Keeps the bot's nickname in each guild, and its presence, in step with the active persona.
+
+    Callers only record the desired state. An edit becomes due once the
+    desired value has held for `debounce` seconds, so rapid persona flips in
+    a guild collapse into the last one. Edits that would not change anything
+    are dropped. drain() applies due edits at up to `rate` per second, and
+    stops early whenever `is_busy()` reports replies waiting to be sent, so
+    cosmetic updates never compete with replies for Discord's rate limits.
+    Presence updates go out at most once per `presence_interval` seconds.
+    """
+
+    def __init__(self, bot, is_busy=None, rate=NICKNAME_EDIT_RATE, debounce=NICKNAME_DEBOUNCE, presence_interval=PRESENCE_MIN_INTERVAL):
+        self.bot = bot
+        self.is_busy = is_busy or (lambda: False)
+        self.debounce = debounce
+        self.presence_interval = presence_interval
+        self.bucket = TokenBucket(rate, max(1.0, rate))
+        self.current = {}  # Guild ID -> nickname last applied
+        self._pending = {}  # Guild ID -> [nickname, monotonic time the edit is due]
+        self._blocked_until = {}  # Guild ID -> monotonic time after which edits are tried again
+        self.activity = None  # Activity name last applied
+        self._pending_activity = None  # [activity name, due time]
+        self._presence_sent_at = float('-inf')
+        self.edits = 0
+        self.skipped = 0
+        self.failures = 0
+
+    @property
+    def pending(self):
+        return len(self._pending) + (self._pending_activity is not None)
+
+    def want_nickname(self, guild_id, nickname):
+        """Record the nickname the bot should have in a guild."""
+        if self.current.get(guild_id) == nickname:
+            if self._pending.pop(guild_id, None) is not None:
+                self.skipped += 1  # Flipped back before the edit was due
+            return
+        entry = self._pending.get(guild_id)
+        if entry is not None and entry[0] == nickname:
+            return  # Keep the original due time
+        self._pending[guild_id] = [nickname, time.monotonic() + self.debounce]
+
+    def want_activity(self, name):
+        """Record the activity the bot's presence should show."""
+        if name == self.activity:
+            self._pending_activity = None
+            return
+        if self._pending_activity is not None and self._pending_activity[0] == name:
+            return
+        due = max(time.monotonic() + self.debounce, self._presence_sent_at + self.presence_interval)
+        self._pending_activity = [name, due]
+
+    def forget_guild(self, guild_id):
+        self.current.pop(guild_id, None)
+        self._pending.pop(guild_id, None)
+        self._blocked_until.pop(guild_id, None)
+
+    async def drain(self):
+        """Apply due edits, oldest first, while the edit bucket has tokens and no reply is waiting."""
+        now = time.monotonic()
+        if self._pending_activity is not None and self._pending_activity[1] <= now and not self.is_busy():
+            await self._apply_activity()
+        due = sorted((entry[1], guild_id) for guild_id, entry in self._pending.items() if entry[1] <= now)
+        for _, guild_id in due:
+            if self.is_busy() or self.bucket.delay() > 0:
+                break
+            if self._blocked_until.get(guild_id, 0.0) > now:
+                continue
+            nickname, _ = self._pending.pop(guild_id)
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                self.forget_guild(guild_id)
+                continue
+            if guild.me.nick == nickname:
+                self.current[guild_id] = nickname
+                self.skipped += 1
+                continue
+            self.bucket.take()
+            await self._apply_nickname(guild, nickname)
+
+    async def _apply_nickname(self, guild, nickname):
+        try:
+            await guild.me.edit(nick=nickname)
+        except discord.Forbidden:
+            self._blocked_until[guild.id] = time.monotonic() + FORBIDDEN_RETRY
+            logger.info("Not allowed to change the nickname in guild %s; retrying in %.0f minutes.", guild.id, FORBIDDEN_RETRY / 60)
+            self.failures += 1
+            return
+        except discord.HTTPException as e:
+            self._pending.setdefault(guild.id, [nickname, time.monotonic() + FAILED_RETRY])
+            logger.warning("Nickname update in guild %s failed: %s", guild.id, e)
+            self.failures += 1
+            return
+        self.current[guild.id] = nickname
+        self.edits += 1
+        count('nickname_edit')
+
+    async def _apply_activity(self):
+        name, _ = self._pending_activity
+        self._pending_activity = None
+        try:
+            await self.bot.change_presence(activity=discord.Game(name=name))
+        except Exception as e:
+            logger.warning("Presence update failed: %s", e)
+            self._pending_activity = [name, time.monotonic() + FAILED_RETRY]
+            self.failures += 1
+            return
+        self.activity = name
+        self._presence_sent_at = time.monotonic()
+        count('presence_update')
+
+    def stats(self):
+        return {'pending': self.pending, 'edits': self.edits, 'skipped': self.skipped, 'failures': self.failures}
@@ -0,0 +1,109 @@
+# prompts.py
+import re
+import time
+import datetime
+from functools import lru_cache
+from pytz import timezone
+from cache import LRUCache
+from metrics import instrument
+
+PACIFIC = timezone('US/Pacific')
+RENDERED_PROMPT_CACHE_SIZE = 4096
+VOLATILE_FIELDS = ('user_name', 'server_name', 'channel_name', 'current_time')
+# What a {user_name} inside the static text becomes; the name itself is given in the trailing block
+STATIC_USER_REFERENCE = 'the user'
+
+_FIELD_PATTERN = re.compile(r'\{(' + '|'.join(VOLATILE_FIELDS) + r')\}')
+_USER_APPOSITIVE = re.compile(r',\s*\{user_name\},')  # "the current user, {user_name}, as" -> "the current user as"
+_CLOSING_TAG = re.compile(r'^</[^>]+>$')
+
+_current_minute = [None, '']  # [minute since the epoch, its formatted time]
+
+def current_time_text(now=None):
+    """Pacific time to the minute, so the rendered prompt only changes once a minute."""
+    if now is not None:
+        return now.strftime('%Y-%m-%d %H:%M %Z')
+    minute = int(time.time() // 60)
+    if _current_minute[0] != minute:
+        _current_minute[:] = [minute, datetime.datetime.now(PACIFIC).strftime('%Y-%m-%d %H:%M %Z')]
+    return _current_minute[1]
+
+class PromptTemplate:
+    """
+    A persona system prompt parsed into a static prefix and a small volatile block.
+
+    Lines that mention the server, channel or time are moved, in order, to a
+    block at the end. {user_name} elsewhere is replaced with a fixed reference,
+    and the name is given in that block. The prefix is then byte-identical
+    for every render, so provider-side prompt caching can reuse it. Closing
+    tags such as </System Prompt> stay last.
+    """
+
+    def __init__(self, text):
+        lines = text.strip('\n').split('\n')
+        suffix = []
+        while lines and _CLOSING_TAG.match(lines[-1].strip()):
+            suffix.insert(0, lines.pop())
+
+        static, volatile = [], []
+        user_in_static = False
+        for line in lines:
+            fields = set(_FIELD_PATTERN.findall(line))
+            if fields - {'user_name'}:
+                volatile.append(line)
+            elif fields:
+                user_in_static = True
+                line = _USER_APPOSITIVE.sub('', line).replace('{user_name}', STATIC_USER_REFERENCE)
+                static.append(line)
+            else:
+                static.append(line)
+        while static and not static[-1].strip():
+            static.pop()
+        if user_in_static and not any('{user_name}' in line for line in volatile):
+            volatile.insert(0, 'You are talking with {user_name}.')
+
+        self.static_prefix = '\n'.join(static)
+        self.volatile = '\n'.join(volatile)
+        self.suffix = '\n'.join(suffix)
+
+    def render(self, user_name, server_name, channel_name, current_time=None):
+        values = {
+            'user_name': user_name,
+            'server_name': server_name,
+            'channel_name': channel_name,
+            'current_time': current_time or current_time_text(),
+        }
+        parts = [self.static_prefix]
+        if self.volatile:
+            parts.append(_FIELD_PATTERN.sub(lambda match: values[match.group(1)], self.volatile))
+        if self.suffix:
+            parts.append(self.suffix)
+        return '\n\n'.join(parts)
+
+@lru_cache(maxsize=64)
+def compile_template(text):
+    """Parse a prompt template once per distinct text."""
+    return PromptTemplate(text)
+
+class PromptRenderer:
+    """Memoizes rendered persona prompts per (persona, guild, channel) until a field or the minute changes."""
+
+    def __init__(self, maxsize=RENDERED_PROMPT_CACHE_SIZE):
+        self._rendered = LRUCache(maxsize)
+
+    @instrument('prompt_render')
+    def render(self, persona, text, user_name, server_name, channel_name, guild_id=None, channel_id=None):
+        template = compile_template(text)
+        fields = (template, user_name, server_name, channel_name, current_time_text())
+        key = (persona, guild_id, channel_id)
+        cached = self._rendered.get(key)
+        if cached is not None and cached[0] == fields:
+            return cached[1]
+        prompt = template.render(user_name, server_name, channel_name, fields[-1])
+        self._rendered.set(key, (fields, prompt))
+        return prompt
+
+    def stats(self):
+        return {'hits': self._rendered.hits, 'misses': self._rendered.misses, 'size': len(self._rendered)}
+
+prompt_renderer = PromptRenderer()
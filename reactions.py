@@ -0,0 +1,121 @@
+# reactions.py
+import re
+import asyncio
+from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+from config import REACTION_LOCAL_CONFIDENCE, REACTION_CACHE_ENABLED, get_logger
+from openapi import get_reaction_response, get_batch_reaction_response, reaction_cache, reaction_cache_key
+from helpers import get_reaction_system_prompt
+from scheduler import scheduler, Priority, RequestShed
+
+logger = get_logger('reactions')
+
+REACTION_BATCH_SIZE = 8  # Low-confidence messages folded into one LLM call
+REACTION_BATCH_WAIT = 0.75  # Seconds to wait for more messages before calling the LLM
+
+# Unambiguous cues, checked before sentiment scores: (pattern, emoji, confidence)
+REACTION_CUES = [
+    (re.compile(r"(?i)(\b(lol|lmao|lmfao|rofl|haha+|hehe+|ahaha+)\b|😂|🤣)"), "😂", 0.9),
+    (re.compile(r"(?i)(\b(ily|ilysm|love (you|u|this|it))\b|<3|❤️)"), "❤️", 0.85),
+    (re.compile(r"(?i)\b(thanks|thank you|thx|tysm)\b"), "🥰", 0.8),
+]
+
+class SentimentReactionClassifier:
+    """Picks an emoji from VADER sentiment scores and keyword cues, with a confidence in [0, 1]."""
+
+    def __init__(self):
+        self._analyzer = None
+
+    def classify(self, content):
+        """Return (emoji, confidence); emoji is None when the sentiment is neutral."""
+        for pattern, emoji, confidence in REACTION_CUES:
+            if pattern.search(content):
+                return emoji, confidence
+        if self._analyzer is None:
+            self._analyzer = SentimentIntensityAnalyzer()
+        compound = self._analyzer.polarity_scores(content)['compound']
+        if compound >= 0.8:
+            return "😍", compound
+        if compound >= 0.3:
+            return "😊", compound
+        if compound <= -0.3:
+            return "😢", -compound
+        return None, 0.0
+
+class ReactionBatcher:
+    """
+    Collects messages the local classifier is unsure about and asks the LLM for
+    all of their reactions in one call, after REACTION_BATCH_WAIT seconds or as
+    soon as REACTION_BATCH_SIZE messages are waiting.
+    """
+
+    def __init__(self, max_batch=REACTION_BATCH_SIZE, max_wait=REACTION_BATCH_WAIT):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending = []  # (content, future)
+        self._timer = None
+        self._flushes = set()
+
+    @property
+    def idle(self):
+        return not self._pending and not self._flushes
+
+    async def submit(self, content):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((content, future))
+        if len(self._pending) >= self.max_batch:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._flush(batch))
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch):
+        async def call():
+            if len(batch) == 1:
+                return [await get_reaction_response([
+                    {"role": "system", "content": get_reaction_system_prompt()},
+                    {"role": "user", "content": batch[0][0]}
+                ])]
+            return await get_batch_reaction_response([content for content, _ in batch])
+
+        try:
+            # Batches mix guilds, so they share one fair-queuing slot
+            reactions = await scheduler.run(Priority.REACTION, None, call)
+            reaction_stats['llm_calls'] += 1
+        except RequestShed:
+            reactions = [None] * len(batch)
+        except Exception as e:
+            logger.error("Error during batched reaction call: %s", e, exc_info=True)
+            reactions = [None] * len(batch)
+        for (_, future), reaction in zip(batch, reactions):
+            if not future.done():
+                future.set_result(reaction)
+
+classifier = SentimentReactionClassifier()
+batcher = ReactionBatcher()
+reaction_stats = {'local': 0, 'llm': 0, 'llm_calls': 0, 'unanswered': 0}
+
+async def choose_reaction(content):
+    """Pick an emoji reaction for a message: locally when the sentiment is clear, otherwise via the LLM."""
+    emoji, confidence = classifier.classify(content)
+    if emoji is not None and confidence >= REACTION_LOCAL_CONFIDENCE:
+        reaction_stats['local'] += 1
+        return emoji
+    if REACTION_CACHE_ENABLED:
+        cached = reaction_cache.get(reaction_cache_key(content))
+        if cached is not None:
+            return cached
+    reaction_stats['llm'] += 1
+    reaction = await batcher.submit(content)
+    if reaction is None:
+        reaction_stats['unanswered'] += 1
+    return reaction
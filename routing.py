@@ -0,0 +1,281 @@
+# routing.py
+import asyncio
+import random
+import time
+from config import (
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_ERROR_RATE,
+    CIRCUIT_COOLDOWN,
+    CIRCUIT_MAX_COOLDOWN,
+    LLM_RETRY_ATTEMPTS,
+    LLM_RETRY_BACKOFF,
+    get_logger
+)
+from metrics import count
+
+logger = get_logger('routing')
+
+# Statuses that describe the request rather than the endpoint; another endpoint would answer the same
+REQUEST_ERRORS = {400, 404, 413, 422}
+
+class NoHealthyEndpoint(Exception):
+    """Raised when every endpoint of a tier has its circuit open."""
+
+class CircuitBreaker:
+    """
+    Stops traffic to an endpoint that keeps failing.
+
+    The circuit opens after `failure_threshold` consecutive failures, or when
+    the rolling error rate reaches `error_rate` over at least `min_samples`
+    calls. After `cooldown` seconds it is half-open: one request is let
+    through as a probe. A successful probe closes the circuit; a failed one
+    opens it again for twice as long, up to `max_cooldown`.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, error_rate=CIRCUIT_ERROR_RATE,
+                 cooldown=CIRCUIT_COOLDOWN, max_cooldown=CIRCUIT_MAX_COOLDOWN, min_samples=10, alpha=0.1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.min_samples = min_samples
+        self.alpha = alpha
+        self.error_rate = 0.0  # Exponentially weighted share of failed calls
+        self.samples = 0
+        self.consecutive_failures = 0
+        self.cooldown = cooldown
+        self.probing = False
+        self.trips = 0
+        self._open_until = None
+
+    @property
+    def state(self):
+        if self._open_until is None:
+            return self.CLOSED
+        return self.OPEN if time.monotonic() < self._open_until else self.HALF_OPEN
+
+    def available(self):
+        """Whether a request may be sent now: the circuit is closed, or half-open with no probe out."""
+        state = self.state
+        return state == self.CLOSED or (state == self.HALF_OPEN and not self.probing)
+
+    def begin(self):
+        if self.state == self.HALF_OPEN:
+            self.probing = True
+
+    def _observe(self, failed):
+        self.samples += 1
+        self.error_rate += self.alpha * ((1.0 if failed else 0.0) - self.error_rate)
+
+    def record_success(self):
+        self._observe(False)
+        self.consecutive_failures = 0
+        self.probing = False
+        if self._open_until is not None:
+            logger.info("Circuit for %s closed after a successful probe.", self.name)
+            self._open_until = None
+            self.cooldown = self.base_cooldown
+            self.error_rate = 0.0
+
+    def record_failure(self):
+        self._observe(True)
+        self.consecutive_failures += 1
+        if self._open_until is not None:
+            if self.probing:
+                self.probing = False
+                self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+                self._trip("probe failed")
+            return
+        if self.consecutive_failures >= self.failure_threshold:
+            self._trip(f"{self.consecutive_failures} consecutive failures")
+        elif self.samples >= self.min_samples and self.error_rate >= self.error_rate_threshold:
+            self._trip(f"error rate {self.error_rate:.0%}")
+
+    def release(self):
+        """End a call without a verdict (cancelled, or rejected for reasons unrelated to the endpoint)."""
+        self.probing = False
+
+    def _trip(self, reason):
+        self.trips += 1
+        self._open_until = time.monotonic() + self.cooldown
+        count('circuit_open')
+        logger.warning("Circuit for %s opened (%s); retrying it in %.0fs.", self.name, reason, self.cooldown)
+
+class Endpoint:
+    """One base URL and API key for a model tier, with its circuit breaker and rolling latency."""
+
+    def __init__(self, name, client, breaker=None, alpha=0.2):
+        self.name = name
+        self.client = client
+        self.breaker = breaker or CircuitBreaker(name)
+        self.alpha = alpha
+        self.latency = None  # Exponentially weighted seconds per successful call
+        self.in_flight = 0
+        self.calls = 0
+        self.successes = 0
+        self.failures = 0
+
+    def score(self):
+        """Lower is better: expected latency, inflated by queued calls and the recent error rate."""
+        latency = self.latency if self.latency is not None else 0.0  # Untried endpoints get a chance
+        return (latency + 0.01) * (1 + self.in_flight) / max(0.05, 1.0 - self.breaker.error_rate)
+
+    def begin(self):
+        self.in_flight += 1
+        self.calls += 1
+        self.breaker.begin()
+
+    def succeeded(self, latency):
+        self.in_flight -= 1
+        self.successes += 1
+        self.latency = latency if self.latency is None else self.latency + self.alpha * (latency - self.latency)
+        self.breaker.record_success()
+
+    def failed(self):
+        self.in_flight -= 1
+        self.failures += 1
+        self.breaker.record_failure()
+
+    def released(self):
+        self.in_flight -= 1
+        self.breaker.release()
+
+class UpstreamRouter:
+    """
+    Sends each request to the healthiest endpoint of its tier.
+
+    A half-open endpoint takes the next request as its recovery probe;
+    otherwise the closed endpoint with the best score is used. Failed calls
+    are retried on another endpoint after a jittered exponential backoff,
+    up to `attempts` tries in total. Open circuits are skipped, so when a
+    whole tier is down requests fail fast with NoHealthyEndpoint instead of
+    waiting out timeouts. When `admit` is given, each retry awaits it after
+    the backoff, so retries count against the caller's rate limit too.
+    """
+
+    def __init__(self, tiers, attempts=LLM_RETRY_ATTEMPTS, backoff=LLM_RETRY_BACKOFF, max_backoff=5.0, admit=None):
+        self.tiers = tiers  # tier name -> list of Endpoint
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.admit = admit
+
+    def endpoints(self):
+        return [endpoint for endpoints in self.tiers.values() for endpoint in endpoints]
+
+    def pick(self, tier, exclude=()):
+        """The endpoint for the next call, preferring ones not in `exclude`; None if every circuit is open."""
+        available = [endpoint for endpoint in self.tiers[tier] if endpoint.breaker.available()]
+        candidates = [endpoint for endpoint in available if endpoint not in exclude] or available
+        if not candidates:
+            return None
+        for endpoint in candidates:
+            if endpoint.breaker.state == CircuitBreaker.HALF_OPEN:
+                return endpoint
+        return min(candidates, key=Endpoint.score)
+
+    def _delay(self, attempt):
+        """Full jitter: uniform between zero and the exponential backoff for this attempt."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    async def _next_endpoint(self, tier, attempt, tried):
+        if attempt:
+            count('llm_retry')
+            await asyncio.sleep(self._delay(attempt))
+            if self.admit is not None:
+                await self.admit()
+        endpoint = self.pick(tier, tried)
+        if endpoint is not None:
+            tried.append(endpoint)
+            endpoint.begin()
+        return endpoint
+
+    async def call(self, tier, request):
+        """Await `request(client)` on the healthiest endpoint of `tier`, retrying elsewhere on failure."""
+        tried = []
+        last_error = None
+        for attempt in range(self.attempts):
+            endpoint = await self._next_endpoint(tier, attempt, tried)
+            if endpoint is None:
+                break
+            started = time.monotonic()
+            try:
+                result = await request(endpoint.client)
+            except asyncio.CancelledError:
+                endpoint.released()
+                raise
+            except Exception as e:
+                if getattr(e, 'status', None) in REQUEST_ERRORS:
+                    endpoint.released()
+                    raise
+                endpoint.failed()
+                last_error = e
+                logger.warning("Call to %s failed (%s: %s); attempt %d of %d.", endpoint.name, type(e).__name__, e, attempt + 1, self.attempts)
+                continue
+            endpoint.succeeded(time.monotonic() - started)
+            return result
+        if last_error is not None:
+            raise last_error
+        raise NoHealthyEndpoint(f"Every {tier} endpoint has its circuit open.")
+
+    async def stream(self, tier, request):
+        """
+        Yield from `request(client)`, an async iterator, on the healthiest endpoint of `tier`.
+        Failures before the first item are retried on another endpoint; after
+        that the items already yielded cannot be taken back, so errors propagate.
+        """
+        tried = []
+        last_error = None
+        for attempt in range(self.attempts):
+            endpoint = await self._next_endpoint(tier, attempt, tried)
+            if endpoint is None:
+                break
+            started = time.monotonic()
+            first = True
+            try:
+                async for item in request(endpoint.client):
+                    if first:
+                        first = False
+                        endpoint.succeeded(time.monotonic() - started)  # Time to first token
+                    yield item
+            except (asyncio.CancelledError, GeneratorExit):
+                if first:
+                    endpoint.released()
+                raise
+            except Exception as e:
+                if not first:
+                    endpoint.breaker.record_failure()
+                    raise
+                if getattr(e, 'status', None) in REQUEST_ERRORS:
+                    endpoint.released()
+                    raise
+                endpoint.failed()
+                last_error = e
+                logger.warning("Stream from %s failed (%s: %s); attempt %d of %d.", endpoint.name, type(e).__name__, e, attempt + 1, self.attempts)
+                continue
+            if first:
+                endpoint.succeeded(time.monotonic() - started)  # An empty stream still answered
+            return
+        if last_error is not None:
+            raise last_error
+        raise NoHealthyEndpoint(f"Every {tier} endpoint has its circuit open.")
+
+    def stats(self):
+        """Health of each endpoint, keyed by name."""
+        return {
+            endpoint.name: {
+                'state': endpoint.breaker.state,
+                'latency': endpoint.latency,
+                'error_rate': endpoint.breaker.error_rate,
+                'in_flight': endpoint.in_flight,
+                'calls': endpoint.calls,
+                'successes': endpoint.successes,
+                'failures': endpoint.failures,
+                'trips': endpoint.breaker.trips,
+            }
+            for endpoint in self.endpoints()
+        }
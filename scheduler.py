@@ -0,0 +1,260 @@
+# scheduler.py
+import asyncio
+import contextvars
+import time
+from collections import OrderedDict, deque
+from enum import IntEnum
+from config import LLM_RATE_LIMIT, LLM_RATE_BURST, SCHEDULER_MAX_QUEUE, get_logger
+from metrics import register_gauge
+
+logger = get_logger('scheduler')
+
+class Priority(IntEnum):
+    """Request classes, most important first."""
+    MENTION = 0
+    TRIGGER = 1
+    RANDOM_REPLY = 2
+    REACTION = 3
+    BACKGROUND = 4  # Housekeeping calls such as conversation summaries
+
+# Seconds a sheddable request may wait before it is dropped instead of sent
+SHED_AFTER = {
+    Priority.RANDOM_REPLY: 15.0,
+    Priority.REACTION: 10.0,
+    Priority.BACKGROUND: 30.0,
+}
+
+class RequestShed(Exception):
+    """Raised when the scheduler drops a request under overload."""
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+class _Ticket:
+    __slots__ = ('priority', 'guild_id', 'future', 'enqueued_at')
+
+    def __init__(self, priority, guild_id, future):
+        self.priority = priority
+        self.guild_id = guild_id
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+class _Job:
+    """The priority and guild of the job being run, shared with the upstream calls it makes."""
+    __slots__ = ('priority', 'guild_id', 'prepaid')
+
+    def __init__(self, priority, guild_id):
+        self.priority = priority
+        self.guild_id = guild_id
+        self.prepaid = True  # run() already took the token for the first upstream call
+
+_current_job = contextvars.ContextVar('scheduler_job', default=None)
+
+class RequestScheduler:
+    """
+    Admits upstream LLM calls in priority order, fairly across guilds, within a rate limit.
+
+    A job (one reply, reaction batch or summary) enters through run(), which
+    waits for the token of its first upstream call. Every further call the
+    job makes (refusal retries, hedges, router retries) waits in acquire()
+    at the job's priority and takes a token of its own, so the bucket bounds
+    the calls the upstream sees, not just the jobs.
+
+    Each priority class keeps one queue per guild and serves the guilds
+    round-robin, so a busy guild cannot starve the others in its class.
+    Calls are released at the token bucket's rate. Once `max_queue`
+    requests are waiting, a new request displaces one from a less important
+    class (taken from the guild with the most queued). Random replies,
+    reactions and background work that cannot displace anything, or that
+    have waited longer than SHED_AFTER, are shed with RequestShed. Mentions
+    and trigger words are never shed.
+    """
+
+    def __init__(self, rate=LLM_RATE_LIMIT, burst=LLM_RATE_BURST, max_queue=SCHEDULER_MAX_QUEUE, shed_after=SHED_AFTER):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_queue = max_queue
+        self.shed_after = shed_after
+        self._queues = {priority: OrderedDict() for priority in Priority}  # guild -> deque of tickets, next guild first
+        self._depth = {priority: 0 for priority in Priority}
+        self._dispatcher = None
+        self.dispatched = {priority: 0 for priority in Priority}
+        self.shed = {priority: 0 for priority in Priority}
+        self._wait_total = {priority: 0.0 for priority in Priority}
+        self._wait_max = {priority: 0.0 for priority in Priority}
+
+    @property
+    def depth(self):
+        return sum(self._depth.values())
+
+    def waiting(self, through=Priority.BACKGROUND):
+        """Requests queued at `through` or a more important priority."""
+        return sum(depth for priority, depth in self._depth.items() if priority <= through)
+
+    async def run(self, priority, guild_id, fn):
+        """Wait for a slot, then return `await fn()`. Raises RequestShed if the request is dropped."""
+        await self._wait(priority, guild_id)
+        token = _current_job.set(_Job(priority, guild_id))
+        try:
+            return await fn()
+        finally:
+            _current_job.reset(token)
+
+    async def acquire(self):
+        """
+        Wait for the token of one upstream call. Inside run() the first call is
+        already paid for and later ones queue at the job's priority; calls made
+        outside any job queue as background work. Raises RequestShed if dropped.
+        """
+        job = _current_job.get()
+        if job is None:
+            await self._wait(Priority.BACKGROUND, None)
+        elif job.prepaid:
+            job.prepaid = False
+        else:
+            await self._wait(job.priority, job.guild_id)
+
+    async def _wait(self, priority, guild_id):
+        if self.depth == 0 and self.bucket.delay() == 0:
+            self.bucket.take()
+            self._record_wait(priority, 0.0)
+        else:
+            await self._admit(priority, guild_id).future
+
+    def stats(self):
+        """Queue depth, dispatch and shed counts, and wait times per priority class."""
+        return {
+            priority.name.lower(): {
+                'depth': self._depth[priority],
+                'dispatched': self.dispatched[priority],
+                'shed': self.shed[priority],
+                'wait_avg': self._wait_total[priority] / self.dispatched[priority] if self.dispatched[priority] else 0.0,
+                'wait_max': self._wait_max[priority],
+            }
+            for priority in Priority
+        }
+
+    def _admit(self, priority, guild_id):
+        if self.depth >= self.max_queue and not self._displace(priority):
+            if priority in self.shed_after:
+                self.shed[priority] += 1
+                raise RequestShed(f"{priority.name} request shed: {self.depth} requests queued")
+        ticket = _Ticket(priority, guild_id, asyncio.get_running_loop().create_future())
+        # A cancelled waiter leaves the queue straight away, even if the dispatcher wakes on the same tick
+        ticket.future.add_done_callback(lambda future: future.cancelled() and self._remove(ticket))
+        self._queues[priority].setdefault(guild_id, deque()).append(ticket)
+        self._depth[priority] += 1
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        return ticket
+
+    def _displace(self, priority):
+        """Shed the oldest request of the busiest guild in the least important class below `priority`."""
+        for lower in sorted(self.shed_after, reverse=True):
+            if lower <= priority or not self._depth[lower]:
+                continue
+            queues = self._queues[lower]
+            guild_id = max(queues, key=lambda guild: len(queues[guild]))
+            self._shed(self._pop(lower, guild_id))
+            return True
+        return False
+
+    def _pop(self, priority, guild_id):
+        queues = self._queues[priority]
+        queue = queues[guild_id]
+        ticket = queue.popleft()
+        if queue:
+            queues.move_to_end(guild_id)
+        else:
+            del queues[guild_id]
+        self._depth[priority] -= 1
+        return ticket
+
+    def _remove(self, ticket):
+        queue = self._queues[ticket.priority].get(ticket.guild_id)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            self._depth[ticket.priority] -= 1
+            if not queue:
+                del self._queues[ticket.priority][ticket.guild_id]
+
+    def _shed(self, ticket):
+        self.shed[ticket.priority] += 1
+        if not ticket.future.done():
+            ticket.future.set_exception(RequestShed(f"{ticket.priority.name} request shed under load"))
+        logger.debug("Shed a %s request for guild %s", ticket.priority.name, ticket.guild_id)
+
+    def _next(self):
+        for priority in Priority:
+            queues = self._queues[priority]
+            if queues:
+                return self._pop(priority, next(iter(queues)))
+        return None
+
+    def _record_wait(self, priority, wait):
+        self.dispatched[priority] += 1
+        self._wait_total[priority] += wait
+        self._wait_max[priority] = max(self._wait_max[priority], wait)
+
+    async def _dispatch(self):
+        try:
+            while self.depth:
+                delay = self.bucket.delay()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                ticket = self._next()
+                if ticket.future.done():
+                    continue  # Cancelled before its turn came
+                wait = time.monotonic() - ticket.enqueued_at
+                limit = self.shed_after.get(ticket.priority)
+                if limit is not None and wait > limit:
+                    self._shed(ticket)
+                    continue
+                self.bucket.take()
+                self._record_wait(ticket.priority, wait)
+                ticket.future.set_result(None)
+        finally:
+            self._dispatcher = None
+
+scheduler = RequestScheduler()
+
+register_gauge(
+    'sydneybot_scheduler_queue_depth', 'Upstream calls waiting in the scheduler.', ('priority',),
+    lambda: {(priority.name.lower(),): scheduler._depth[priority] for priority in Priority}
+)
+register_gauge(
+    'sydneybot_scheduler_dispatched_total', 'Upstream calls released by the scheduler.', ('priority',),
+    lambda: {(priority.name.lower(),): scheduler.dispatched[priority] for priority in Priority}, kind='counter'
+)
+register_gauge(
+    'sydneybot_scheduler_wait_seconds_total', 'Seconds released calls spent queued; divide by dispatched for the mean.', ('priority',),
+    lambda: {(priority.name.lower(),): scheduler._wait_total[priority] for priority in Priority}, kind='counter'
+)
+register_gauge(
+    'sydneybot_scheduler_wait_max_seconds', 'Longest queue wait of a released call.', ('priority',),
+    lambda: {(priority.name.lower(),): scheduler._wait_max[priority] for priority in Priority}
+)
+register_gauge(
+    'sydneybot_scheduler_shed_total', 'Upstream calls dropped by the scheduler under load.', ('priority',),
+    lambda: {(priority.name.lower(),): scheduler.shed[priority] for priority in Priority}, kind='counter'
+)
@@ -0,0 +1,135 @@
+# streaming.py
+import time
+import asyncio
+import discord
+from config import get_logger
+from helpers import is_refusal, split_message
+from openapi import stream_completion, MODEL_REGULAR, MODEL_EXPENSIVE
+from metrics import instrument, count
+from scheduler import RequestShed
+
+logger = get_logger('streaming')
+
+DISCORD_MESSAGE_LIMIT = 2000
+EDIT_INTERVAL = 1.0  # Seconds between edits of a message; Discord allows about 5 edits per 5s per channel
+REFUSAL_CHECK_CHARS = 80  # Characters buffered before posting, so a refusal can be retried unseen
+
+class StreamingReply:
+    """
+    Posts a reply while it is still being generated.
+
+    Text is appended with `feed`; the Discord message is edited at most once per
+    `edit_interval`. `transform` (e.g. mention rewriting) is applied to the
+    text first, and the result is split at line or word breaks into as many
+    messages as the limit needs, the same way buffered replies are split.
+    Messages left over when the text re-splits into fewer chunks are deleted.
+    """
+
+    def __init__(self, channel, reference=None, transform=None, edit_interval=EDIT_INTERVAL, limit=DISCORD_MESSAGE_LIMIT):
+        self.channel = channel
+        self.reference = reference
+        self.transform = transform or (lambda text: text)
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self.text = ''
+        self._messages = []  # Sent discord.Message objects, one per chunk
+        self._sent = []  # Content last sent for each message
+        self._last_flush = 0.0
+
+    async def feed(self, delta):
+        self.text += delta
+        if time.monotonic() - self._last_flush >= self.edit_interval:
+            await self.flush()
+
+    @instrument('discord_send')
+    async def flush(self):
+        """Send new chunks, edit changed ones and delete any that are no longer needed."""
+        self._last_flush = time.monotonic()
+        # Split after transforming, since mentions are longer than the names they replace
+        chunks = split_message(self.transform(self.text).strip(), self.limit)
+        for index, content in enumerate(chunks):
+            if index >= len(self._messages):
+                if index == 0 and self.reference is not None:
+                    message = await self.reference.reply(content)
+                else:
+                    message = await self.channel.send(content)
+                self._messages.append(message)
+                self._sent.append(content)
+            elif self._sent[index] != content:
+                await self._messages[index].edit(content=content)
+                self._sent[index] = content
+        while len(self._messages) > max(1, len(chunks)):
+            message = self._messages.pop()
+            self._sent.pop()
+            try:
+                await message.delete()
+            except discord.HTTPException as e:
+                logger.warning("Could not delete a leftover reply chunk: %s", e)
+
+    async def finish(self):
+        """Wait out the edit interval if needed, then send the final text."""
+        remaining = self.edit_interval - (time.monotonic() - self._last_flush)
+        if self._messages and remaining > 0:
+            await asyncio.sleep(remaining)
+        await self.flush()
+        return self.text
+
+async def stream_reply(channel, messages, tags, reference=None, transform=None, initial_temperature=0.1777, decrement=0.05, min_temperature=0.05, max_retries=3, use_expensive_model=False):
+    """
+    Stream a persona reply into Discord, with the same refusal handling as get_valid_response.
+
+    Until the last attempt, the first REFUSAL_CHECK_CHARS characters are
+    buffered and checked with is_refusal; a refusal aborts the stream and
+    retries (switching to the expensive model) before anything is posted.
+    """
+    temperature = initial_temperature
+    retries = 0
+    reply = None
+
+    while retries < max_retries and temperature >= min_temperature:
+        last_attempt = retries + 1 >= max_retries or temperature - decrement < min_temperature
+        model = MODEL_EXPENSIVE if use_expensive_model else MODEL_REGULAR
+        stream = stream_completion(model, messages, temperature, tags=tags, use_expensive_model=use_expensive_model)
+        head = ''
+        refused = False
+        try:
+            async for delta in stream:
+                if reply is not None:
+                    await reply.feed(delta)
+                    continue
+                head += delta
+                if len(head) >= REFUSAL_CHECK_CHARS:
+                    if not last_attempt and is_refusal(head.strip()):
+                        refused = True
+                        break
+                    reply = StreamingReply(channel, reference=reference, transform=transform)
+                    await reply.feed(head.lstrip())
+            if reply is None and not refused:
+                if not last_attempt and is_refusal(head.strip()):
+                    refused = True
+                elif head.strip():
+                    reply = StreamingReply(channel, reference=reference, transform=transform)
+                    await reply.feed(head.strip())
+        except RequestShed:
+            raise
+        except Exception as e:
+            logger.error("Error during streamed API call: %s", e, exc_info=True)
+            break
+        finally:
+            await stream.aclose()
+
+        if not refused:
+            break
+        logger.warning("Refusal detected in stream at temperature %s. Retrying...", temperature)
+        count('llm_refusal')
+        retries += 1
+        temperature -= decrement
+        if not use_expensive_model:
+            logger.info("Switching to the expensive model due to refusal.")
+            use_expensive_model = True
+
+    if reply is None:
+        # Nothing was shown (the call failed or returned nothing)
+        reply = StreamingReply(channel, reference=reference, transform=transform)
+        await reply.feed("I'm sorry, I couldn't process your request at this time.")
+    return await reply.finish()
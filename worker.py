@@ -0,0 +1,128 @@
+# worker.py
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+class BatchedWorker:
+    """
+    A dedicated thread that runs queued jobs in submission order and batches their side effects.
+
+    Jobs that leave work unflushed (uncommitted writes, buffered file output)
+    call `_mark_dirty`; `_flush` then runs once `flush_interval` seconds have
+    passed since the first of them, when `_flush_due` says so, and on close.
+    Subclasses set up and tear down their resources in `_open` and `_close`
+    (both on the worker thread) and run each job in `_execute`.
+    """
+
+    def __init__(self, name, flush_interval):
+        self.name = name
+        self.flush_interval = flush_interval
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._startup_error = None
+        self._flush_deadline = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Start the worker thread and wait for `_open` to finish (idempotent)."""
+        with self._start_lock:
+            if self.running:
+                return
+            self._ready.clear()
+            self._startup_error = None
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            self._ready.wait()
+            if self._startup_error is not None:
+                self._thread = None
+                raise self._startup_error
+
+    def submit(self, fn, **options):
+        """Queue a job on the worker thread and return a concurrent Future."""
+        if not self.running:
+            self.start()
+        future = Future()
+        self._jobs.put((fn, options, future))
+        return future
+
+    def run_sync(self, fn, **options):
+        """Run a job on the worker thread and block for the result."""
+        return self.submit(fn, **options).result()
+
+    async def run(self, fn, **options):
+        """Run a job on the worker thread without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(fn, **options))
+
+    def close(self):
+        """Flush pending work, run `_close` and stop the worker."""
+        with self._start_lock:
+            if not self.running:
+                return
+            self._jobs.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _open(self):
+        pass
+
+    def _execute(self, fn, options):
+        return fn()
+
+    def _flush(self):
+        pass
+
+    def _close(self):
+        pass
+
+    def _mark_dirty(self):
+        if self._flush_deadline is None:
+            self._flush_deadline = time.monotonic() + self.flush_interval
+
+    def _flush_due(self):
+        return self._flush_deadline is not None and time.monotonic() >= self._flush_deadline
+
+    def _flush_now(self):
+        self._flush()
+        self._flush_deadline = None
+
+    def _run(self):
+        try:
+            self._open()
+        except Exception as e:
+            self._startup_error = e
+            self._ready.set()
+            return
+        self._ready.set()
+
+        while True:
+            timeout = None
+            if self._flush_deadline is not None:
+                timeout = max(0.0, self._flush_deadline - time.monotonic())
+            try:
+                job = self._jobs.get(timeout=timeout)
+            except queue.Empty:
+                self._flush_now()
+                continue
+            if job is None:
+                break
+
+            fn, options, future = job
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = self._execute(fn, options)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            if self._flush_due():
+                self._flush_now()
+
+        self._flush_now()
+        self._close()